@@ -0,0 +1,135 @@
+import base64
+import pickle
+from datetime import datetime
+
+from django.conf import settings
+from django.core.cache.backends.base import DEFAULT_TIMEOUT
+from django.core.cache.backends.db import DatabaseCache as DjangoDatabaseCache
+from django.db import DatabaseError, connections, models, router, transaction
+from django.utils import timezone
+from django.utils.encoding import force_bytes
+
+
+class DatabaseCache(DjangoDatabaseCache):
+    """Django's database cache, except that get_many, set_many and delete_many
+    run a constant number of queries instead of some for every key. add_many
+    adds several keys at once like add."""
+
+    def _prepare_keys(self, keys, version):
+        """Returns a dict mapping the keys as stored in the table to the given keys."""
+        made_keys = {}
+        for key in keys:
+            made_key = self.make_key(key, version=version)
+            self.validate_key(made_key)
+            made_keys[made_key] = key
+        return made_keys
+
+    def _get_expiry(self, timeout):
+        timeout = self.get_backend_timeout(timeout)
+        if timeout is None:
+            expiry = datetime.max
+        elif settings.USE_TZ:
+            expiry = datetime.utcfromtimestamp(timeout)
+        else:
+            expiry = datetime.fromtimestamp(timeout)
+        return expiry.replace(microsecond=0)
+
+    @staticmethod
+    def _convert_expiry(connection, expiry):
+        expression = models.Expression(output_field=models.DateTimeField())
+        for converter in connection.ops.get_db_converters(expression) + expression.get_db_converters(connection):
+            expiry = converter(expiry, expression, connection, {})
+        return expiry
+
+    @staticmethod
+    def _encode(value):
+        # the column expects a string, see DatabaseCache._base_set
+        return base64.b64encode(pickle.dumps(value, pickle.HIGHEST_PROTOCOL)).decode('latin1')
+
+    @staticmethod
+    def _placeholders(keys):
+        return ', '.join(['%s'] * len(keys))
+
+    def _cull_if_full(self, db, cursor, table):
+        cursor.execute("SELECT COUNT(*) FROM %s" % table)
+        if cursor.fetchone()[0] > self._max_entries:
+            self._cull(db, cursor, timezone.now().replace(microsecond=0))
+
+    def get_many(self, keys, version=None):
+        made_keys = self._prepare_keys(keys, version)
+        if not made_keys:
+            return {}
+        db = router.db_for_read(self.cache_model_class)
+        connection = connections[db]
+        table = connection.ops.quote_name(self._table)
+
+        with connection.cursor() as cursor:
+            cursor.execute("SELECT cache_key, value, expires FROM %s WHERE cache_key IN (%s)" % (table, self._placeholders(made_keys)),
+                           list(made_keys))
+            rows = cursor.fetchall()
+
+        # expired entries are treated as missing, they are removed when culling or setting them again
+        now = timezone.now()
+        values = {}
+        for made_key, value, expiry in rows:
+            if self._convert_expiry(connection, expiry) >= now:
+                values[made_keys[made_key]] = pickle.loads(base64.b64decode(force_bytes(connection.ops.process_clob(value))))
+        return values
+
+    def set_many(self, data, timeout=DEFAULT_TIMEOUT, version=None):
+        made_keys = self._prepare_keys(data, version)
+        if not made_keys:
+            return
+        db = router.db_for_write(self.cache_model_class)
+        connection = connections[db]
+        table = connection.ops.quote_name(self._table)
+        expiry = connection.ops.adapt_datetimefield_value(self._get_expiry(timeout))
+        rows = [(made_key, self._encode(data[key]), expiry) for made_key, key in made_keys.items()]
+
+        with connection.cursor() as cursor:
+            self._cull_if_full(db, cursor, table)
+            try:
+                with transaction.atomic(using=db):
+                    cursor.execute("DELETE FROM %s WHERE cache_key IN (%s)" % (table, self._placeholders(made_keys)), list(made_keys))
+                    cursor.executemany("INSERT INTO %s (cache_key, value, expires) VALUES (%%s, %%s, %%s)" % table, rows)
+            except DatabaseError:
+                # like set, fail silently to be threadsafe
+                pass
+
+    def add_many(self, data, timeout=DEFAULT_TIMEOUT, version=None):
+        """Sets the keys that are not in the cache yet. Returns a list of the
+        keys that were set, which is empty if the cache couldn't be written."""
+        made_keys = self._prepare_keys(data, version)
+        if not made_keys:
+            return []
+        db = router.db_for_write(self.cache_model_class)
+        connection = connections[db]
+        table = connection.ops.quote_name(self._table)
+        expiry = connection.ops.adapt_datetimefield_value(self._get_expiry(timeout))
+        now = connection.ops.adapt_datetimefield_value(timezone.now().replace(microsecond=0))
+
+        with connection.cursor() as cursor:
+            self._cull_if_full(db, cursor, table)
+            try:
+                with transaction.atomic(using=db):
+                    cursor.execute("DELETE FROM %s WHERE cache_key IN (%s) AND expires < %%s" % (table, self._placeholders(made_keys)),
+                                   list(made_keys) + [now])
+                    cursor.execute("SELECT cache_key FROM %s WHERE cache_key IN (%s)" % (table, self._placeholders(made_keys)), list(made_keys))
+                    existing_keys = {row[0] for row in cursor.fetchall()}
+                    rows = [(made_key, self._encode(data[key]), expiry) for made_key, key in made_keys.items() if made_key not in existing_keys]
+                    if rows:
+                        cursor.executemany("INSERT INTO %s (cache_key, value, expires) VALUES (%%s, %%s, %%s)" % table, rows)
+            except DatabaseError:
+                return []
+        return [made_keys[row[0]] for row in rows]
+
+    def delete_many(self, keys, version=None):
+        made_keys = self._prepare_keys(keys, version)
+        if not made_keys:
+            return
+        db = router.db_for_write(self.cache_model_class)
+        connection = connections[db]
+        table = connection.ops.quote_name(self._table)
+
+        with connection.cursor() as cursor:
+            cursor.execute("DELETE FROM %s WHERE cache_key IN (%s)" % (table, self._placeholders(made_keys)), list(made_keys))
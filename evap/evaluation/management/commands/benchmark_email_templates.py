@@ -0,0 +1,36 @@
+from django.core.management.base import BaseCommand
+from django.template import Context, Template
+
+from evap.evaluation.models import Course, EmailTemplate, UserProfile
+
+import time
+
+
+class Command(BaseCommand):
+    help = 'Compares rendering reminder emails with cached compiled templates to compiling the templates for every email'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--count', type=int, default=10000, help='number of rendered emails')
+        parser.add_argument('--courses', type=int, default=3, help='number of due courses per email')
+
+    def handle(self, *args, **options):
+        template = EmailTemplate.objects.get(name=EmailTemplate.STUDENT_REMINDER)
+        user = UserProfile.objects.filter(first_name__isnull=False).first() or UserProfile(username="jane.doe", first_name="Jane")
+        due_courses = [(course, index) for index, course in enumerate(Course.objects.all()[:options['courses']])]
+        subject_params = {'user': user, 'first_due_in_days': 0}
+        body_params = {'user': user, 'first_due_in_days': 0, 'due_courses': due_courses}
+
+        start = time.perf_counter()
+        for __ in range(options['count']):
+            Template(template.subject).render(Context(subject_params, autoescape=False))
+            Template(template.body).render(Context(body_params, autoescape=False))
+        uncached_time = time.perf_counter() - start
+
+        start = time.perf_counter()
+        for __ in range(options['count']):
+            template.render(subject_params, body_params)
+        cached_time = time.perf_counter() - start
+
+        print("Rendered {} reminders with {} due courses each.".format(options['count'], len(due_courses)))
+        print("Compiling for every email: {:.2f} s ({:.0f} emails/s)".format(uncached_time, options['count'] / uncached_time))
+        print("Cached compiled templates: {:.2f} s ({:.0f} emails/s)".format(cached_time, options['count'] / cached_time))
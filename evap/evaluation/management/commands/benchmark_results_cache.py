@@ -0,0 +1,62 @@
+from django.core.cache import cache
+from django.core.management.base import BaseCommand
+
+from evap.evaluation.models import Course
+from evap.evaluation.tools import calculate_results_for_courses, get_results_cache_keys, ResultMetadata, RESULTS_CACHE_STATES
+
+import pickle
+import time
+
+
+class Command(BaseCommand):
+    help = ('Compares the cached compact results with pickled full result objects: their size and the time a '
+            'request needs to read them from the cache, including looking up the referenced objects for the compact ones')
+
+    def add_arguments(self, parser):
+        parser.add_argument('--semester', type=int, help='only use the courses of the semester with this ID')
+        parser.add_argument('--repeat', type=int, default=5, help='number of measurements, the fastest one is shown')
+
+    def handle(self, *args, **options):
+        courses = Course.objects.filter(state__in=RESULTS_CACHE_STATES)
+        if options['semester']:
+            courses = courses.filter(semester_id=options['semester'])
+        courses = list(courses)
+
+        # fills the cache with the compact results and stores the full results next to them
+        full_results = calculate_results_for_courses(courses)
+        compact_keys = get_results_cache_keys(courses)
+        full_keys = {course: 'benchmark_results_cache-{}'.format(course.id) for course in courses}
+        cache.set_many({full_keys[course]: full_results[course].sections for course in courses}, 600)
+
+        try:
+            def read_full(course):
+                cache.get(full_keys[course])
+
+            def read_compact(course):
+                metadata = ResultMetadata()
+                compact_sections = {course: cache.get(compact_keys[course])}
+                metadata.load(compact_sections)
+                metadata.rehydrate(compact_sections[course])
+
+            full_size = sum(len(pickle.dumps(full_results[course].sections, pickle.HIGHEST_PROTOCOL)) for course in courses)
+            compact_size = sum(len(pickle.dumps(cache.get(compact_keys[course]), pickle.HIGHEST_PROTOCOL)) for course in courses)
+            full_time = self.measure(read_full, courses, options['repeat'])
+            compact_time = self.measure(read_compact, courses, options['repeat'])
+        finally:
+            cache.delete_many(full_keys.values())
+
+        print("Courses: {}".format(len(courses)))
+        print("Full result objects: {} bytes, {:.1f} ms per course to read from the cache".format(full_size, full_time * 1000))
+        print("Compact results: {} bytes, {:.1f} ms per course to read from the cache and rehydrate".format(compact_size, compact_time * 1000))
+
+    @staticmethod
+    def measure(read, courses, repeat):
+        """Returns the fastest of `repeat` measurements of the average time to read the results of one course,
+        as a results page does."""
+        times = []
+        for __ in range(repeat):
+            start = time.perf_counter()
+            for course in courses:
+                read(course)
+            times.append((time.perf_counter() - start) / max(len(courses), 1))
+        return min(times)
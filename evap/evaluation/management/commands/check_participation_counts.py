@@ -0,0 +1,35 @@
+from django.core.management.base import BaseCommand
+from django.db.models import Count
+
+from evap.evaluation.models import Course
+
+
+class Command(BaseCommand):
+    help = 'Compares the stored participant and voter counts of all courses that are not archived with the actual numbers'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--fix', action='store_true', help='store the actual numbers for courses with wrong counts')
+
+    def handle(self, *args, **options):
+        participant_counts = dict(Course.participants.through.objects.values_list('course_id').annotate(Count('id')).order_by())
+        voter_counts = dict(Course.voters.through.objects.values_list('course_id').annotate(Count('id')).order_by())
+
+        num_wrong_courses = 0
+        for course in Course.objects.filter(is_archived=False):
+            participant_count = participant_counts.get(course.id, 0)
+            voter_count = voter_counts.get(course.id, 0)
+            if (course._participant_count, course._voter_count) == (participant_count, voter_count):
+                continue
+
+            num_wrong_courses += 1
+            print("{} (ID {}): stored {} participants and {} voters, actually {} participants and {} voters".format(
+                course, course.id, course._participant_count, course._voter_count, participant_count, voter_count))
+            if options['fix']:
+                Course.objects.filter(pk=course.pk).update(_participant_count=participant_count, _voter_count=voter_count)
+
+        if num_wrong_courses == 0:
+            print("All counts are correct.")
+        elif options['fix']:
+            print("Fixed the counts of {} courses.".format(num_wrong_courses))
+        else:
+            print("{} courses have wrong counts. Use --fix to store the actual numbers.".format(num_wrong_courses))
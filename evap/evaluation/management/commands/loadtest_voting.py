@@ -0,0 +1,196 @@
+from django.core.management.base import BaseCommand, CommandError
+from django.core.servers.basehttp import WSGIServer, WSGIRequestHandler, get_internal_wsgi_application
+from django.core.urlresolvers import reverse
+from django.db import connections, transaction
+
+from evap.evaluation.models import Semester, Course, Contribution, Questionnaire, Question, UserProfile, \
+                                   RatingAnswerCounter, RatingAnswerAggregate, TextAnswer, LoggedBallot, CourseResultSummary
+
+from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor
+from datetime import date
+from http.cookiejar import CookieJar
+from math import ceil
+from urllib.parse import urlencode
+from urllib.request import build_opener, HTTPCookieProcessor, HTTPRedirectHandler
+import random
+import re
+import socketserver
+import threading
+import time
+
+
+class ThreadedWSGIServer(socketserver.ThreadingMixIn, WSGIServer):
+    daemon_threads = True
+
+
+class QuietWSGIRequestHandler(WSGIRequestHandler):
+    def log_message(self, format, *args):
+        pass
+
+
+class NoRedirectHandler(HTTPRedirectHandler):
+    """Doesn't follow redirects, so the response to a vote can be checked."""
+
+    def http_error_302(self, request, response, code, msg, headers):
+        return response
+
+
+def percentile(sorted_values, percent):
+    """Returns the percentile of the sorted values using the nearest-rank method."""
+    if not sorted_values:
+        return float('nan')
+    return sorted_values[max(ceil(percent / 100 * len(sorted_values)) - 1, 0)]
+
+
+class Command(BaseCommand):
+    help = 'Measures how many votes per second the server can handle. Creates a semester with courses and participants for that.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--url', help='base URL of a running server using the same database, e.g. http://localhost:8000. '
+                                          'by default, a server is started in this process')
+        parser.add_argument('--courses', type=int, default=5, help='number of courses each participant votes on')
+        parser.add_argument('--questions', type=int, default=20, help='number of questions per questionnaire')
+        parser.add_argument('--contributors', type=int, default=2, help='number of contributors per course')
+        parser.add_argument('--ballots', type=int, default=200, help='number of votes per concurrency level')
+        parser.add_argument('--concurrency', default='1,5,10,20', help='comma separated numbers of concurrent participants')
+        parser.add_argument('--keep', action='store_true', help='keep the created semester, courses and users')
+
+    def handle(self, *args, **options):
+        try:
+            concurrency_levels = [int(level) for level in options['concurrency'].split(',')]
+        except ValueError:
+            raise CommandError("--concurrency must be a comma separated list of numbers")
+
+        users_per_level = ceil(options['ballots'] / options['courses'])
+        print("Creating {} courses with {} participants...".format(options['courses'], users_per_level * len(concurrency_levels)))
+        semester, courses, participants = self.create_data(options['courses'], options['questions'], options['contributors'], users_per_level * len(concurrency_levels))
+
+        server = None
+        try:
+            base_url = options['url']
+            if not base_url:
+                server = ThreadedWSGIServer(("localhost", 0), QuietWSGIRequestHandler)
+                server.set_app(get_internal_wsgi_application())
+                threading.Thread(target=server.serve_forever, daemon=True).start()
+                base_url = "http://localhost:{}".format(server.server_port)
+            # the server has to see the created data
+            connections.close_all()
+
+            print("{:>11} {:>8} {:>12} {:>9} {:>9} {:>9}".format("concurrency", "ballots", "ballots/s", "p50 ms", "p95 ms", "p99 ms") + "  failures")
+            for index, concurrency in enumerate(concurrency_levels):
+                level_participants = participants[index * users_per_level:(index + 1) * users_per_level]
+                self.run_level(base_url, courses, level_participants, concurrency)
+        finally:
+            if server:
+                server.shutdown()
+                server.server_close()
+            if not options['keep']:
+                print("Deleting the created data...")
+                self.delete_data(semester, participants)
+
+    @staticmethod
+    @transaction.atomic
+    def create_data(num_courses, num_questions, num_contributors, num_participants):
+        semester = Semester.objects.create(name_de="Lasttest {}".format(time.time()), name_en="Load test {}".format(time.time()))
+
+        questionnaire = Questionnaire.objects.create(name_de=semester.name_de, name_en=semester.name_en, public_name_de="Lasttest", public_name_en="Load test")
+        contributor_questionnaire = Questionnaire.objects.create(name_de=semester.name_de + " (Mitwirkende)", name_en=semester.name_en + " (contributors)",
+                                                                 public_name_de="Lasttest", public_name_en="Load test", is_for_contributors=True)
+        for i in range(num_questions):
+            question_type = "T" if i % 10 == 9 else random.choice("LG")
+            Question.objects.create(questionnaire=questionnaire, text_de="Frage {}".format(i), text_en="Question {}".format(i), type=question_type)
+            Question.objects.create(questionnaire=contributor_questionnaire, text_de="Frage {}".format(i), text_en="Question {}".format(i), type=question_type)
+
+        def make_user(username):
+            user = UserProfile(username=username, email="{}@example.com".format(username))
+            user.generate_login_key()
+            user.save()
+            return user
+
+        prefix = "loadtest{}".format(semester.id)
+        participants = [make_user("{}p{}".format(prefix, i)) for i in range(num_participants)]
+        courses = []
+        for i in range(num_courses):
+            course = Course.objects.create(name_de="Lasttest {}".format(i), name_en="Load test {}".format(i), semester=semester, type="Load test",
+                                           vote_start_date=date.today(), vote_end_date=date.today(), state='inEvaluation')
+            course.general_contribution.questionnaires = [questionnaire]
+            for j in range(num_contributors):
+                contributor = make_user("{}c{}_{}".format(prefix, i, j))
+                contribution = Contribution.objects.create(course=course, contributor=contributor, responsible=(j == 0))
+                contribution.questionnaires = [contributor_questionnaire]
+            course.participants = participants
+            courses.append(course)
+
+        return semester, courses, participants
+
+    @staticmethod
+    @transaction.atomic
+    def delete_data(semester, participants):
+        courses = Course.objects.filter(semester=semester)
+        contributions = Contribution.objects.filter(course__in=courses)
+        contributors = UserProfile.objects.filter(contributions__in=contributions)
+        questionnaires = Questionnaire.objects.filter(contributions__in=contributions).distinct()
+
+        for model in (RatingAnswerCounter, RatingAnswerAggregate, TextAnswer):
+            model.objects.filter(contribution__in=contributions).delete()
+        LoggedBallot.objects.filter(course__in=courses).delete()
+        CourseResultSummary.objects.filter(course__in=courses).delete()
+        questionnaire_ids = list(questionnaires.values_list('pk', flat=True))
+        user_ids = list(contributors.values_list('pk', flat=True)) + [participant.pk for participant in participants]
+        courses.delete()
+        Questionnaire.objects.filter(pk__in=questionnaire_ids).delete()
+        UserProfile.objects.filter(pk__in=user_ids).delete()
+        semester.delete()
+
+    def run_level(self, base_url, courses, participants, concurrency):
+        latencies = []
+        failures = []
+
+        def run_participant(participant):
+            opener = build_opener(HTTPCookieProcessor(CookieJar()), NoRedirectHandler())
+            try:
+                opener.open("{}/?{}".format(base_url, urlencode({'userkey': participant.login_key}))).read()
+            except Exception as e:
+                failures.append(e)
+                return
+            for course in courses:
+                start = time.perf_counter()
+                try:
+                    self.vote(opener, base_url + reverse('student:vote', kwargs={'course_id': course.id}))
+                    latencies.append(time.perf_counter() - start)
+                except Exception as e:
+                    failures.append(e)
+
+        start = time.perf_counter()
+        with ThreadPoolExecutor(concurrency) as executor:
+            list(executor.map(run_participant, participants))
+        duration = time.perf_counter() - start
+
+        latencies.sort()
+        print("{:>11} {:>8} {:>12.1f} {:>9.0f} {:>9.0f} {:>9.0f}  {}".format(
+            concurrency, len(latencies), len(latencies) / duration,
+            percentile(latencies, 50) * 1000, percentile(latencies, 95) * 1000, percentile(latencies, 99) * 1000, len(failures)))
+        for failure in failures[:3]:
+            print("    {}".format(failure))
+
+    @staticmethod
+    def vote(opener, url):
+        """Opens the vote page and submits random answers. Raises an exception if the vote is not accepted."""
+        page = opener.open(url).read().decode()
+        csrf_token = re.search(r'name=["\']csrfmiddlewaretoken["\'] value=["\']([^"\']+)', page).group(1)
+
+        data = {'csrfmiddlewaretoken': csrf_token}
+        choices = defaultdict(list)
+        for name, value in re.findall(r'<input[^>]+name="(question_[\d_]+)" type="radio" value="(\d+)"', page):
+            choices[name].append(value)
+        for name, values in choices.items():
+            data[name] = random.choice(values)
+        for name in re.findall(r'<textarea[^>]+name="(question_[\d_]+)"', page):
+            data[name] = random.choice(["", "Lorem ipsum dolor sit amet."])
+
+        response = opener.open(url, urlencode(data).encode())
+        response.read()
+        # a successful vote redirects to the student index
+        if response.status != 302:
+            raise Exception("Vote on {} was not accepted (status {})".format(url, response.status))
@@ -0,0 +1,23 @@
+from django.core.management.base import BaseCommand
+
+from evap.evaluation.tools import process_ballot_log
+
+import time
+
+
+class Command(BaseCommand):
+    help = 'Adds the answers of logged ballots to the answer counters, see settings.DEFERRED_VOTE_AGGREGATION'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--interval', type=float,
+            help='keep running and process the log every INTERVAL seconds instead of processing it once')
+        parser.add_argument('--batch-size', type=int, default=1000, dest='batch_size', help='number of ballots processed per transaction')
+
+    def handle(self, *args, **options):
+        while True:
+            count = process_ballot_log(options['batch_size'])
+            if count:
+                print("Processed {} ballots.".format(count))
+            if not options['interval']:
+                break
+            time.sleep(options['interval'])
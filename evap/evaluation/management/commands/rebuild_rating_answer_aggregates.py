@@ -0,0 +1,20 @@
+from django.core.management.base import BaseCommand
+
+from evap.evaluation.models import Contribution
+from evap.evaluation.tools import rebuild_rating_answer_aggregates
+
+
+class Command(BaseCommand):
+    help = 'Rebuilds the rating answer aggregates from the rating answer counters'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--semester', type=int, help='only rebuild the aggregates of the semester with this ID')
+
+    def handle(self, *args, **options):
+        contributions = Contribution.objects.all()
+        if options['semester']:
+            contributions = contributions.filter(course__semester_id=options['semester'])
+
+        print("Rebuilding rating answer aggregates...")
+        rebuild_rating_answer_aggregates(contributions)
+        print("Done.")
@@ -1,21 +1,65 @@
-from django.core.management.base import BaseCommand
 from django.core.cache import cache
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connection, connections
 
 from evap.evaluation.models import Course
-from evap.evaluation.tools import calculate_results
+from evap.evaluation.tools import calculate_results, get_results_cache_keys, invalidate_results, RESULTS_CACHE_STATES
 
+from multiprocessing import Pool
+import time
+
+
+def refresh_course(course_id):
+    """Calculates and caches the results of a course. Returns the course and
+    the time it took."""
+    start = time.perf_counter()
+    course = Course.objects.get(pk=course_id)
+    calculate_results(course)
+    return course, time.perf_counter() - start
 
 
 class Command(BaseCommand):
-    args = ''
-    help = 'Clears the cache and pre-warms it with the results of all courses'
+    help = 'Pre-warms the cache with the results of all courses'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--semester', type=int, help='only refresh the courses of the semester with this ID')
+        parser.add_argument('--skip-unchanged', action='store_true', dest='skip_unchanged',
+            help='only calculate results that are not cached for their current version instead of invalidating all results')
+        parser.add_argument('--workers', type=int, default=1, help='number of processes calculating results in parallel. '
+            'not supported with SQLite, which can only write from one process at a time')
 
     def handle(self, *args, **options):
-        print("Clearing cache...")
-        cache.clear()
+        if options['workers'] > 1 and connection.vendor == 'sqlite':
+            raise CommandError("--workers is not supported with SQLite, the workers would wait for each other's writes")
+
+        courses = Course.objects.filter(state__in=RESULTS_CACHE_STATES)
+        if options['semester']:
+            courses = courses.filter(semester_id=options['semester'])
+        courses = list(courses)
+
+        if options['skip_unchanged']:
+            cache_keys = get_results_cache_keys(courses)
+            cached_keys = cache.get_many(cache_keys.values()).keys()
+            courses = [course for course in courses if cache_keys[course] not in cached_keys]
+            print("Skipping {} courses with unchanged results...".format(len(cache_keys) - len(courses)))
+        else:
+            print("Invalidating cached results...")
+            invalidate_results(course.id for course in courses)
+
+        print("Calculating results for {} courses...".format(len(courses)))
+        start = time.perf_counter()
+        course_ids = [course.id for course in courses]
+        if options['workers'] > 1:
+            # the worker processes must not share the database connection
+            connections.close_all()
+            with Pool(options['workers']) as pool:
+                self.print_progress(pool.imap_unordered(refresh_course, course_ids), len(course_ids))
+        else:
+            self.print_progress(map(refresh_course, course_ids), len(course_ids))
 
-        print("Calculating results for all courses...")
-        for course in Course.objects.all():
-            calculate_results(course)
+        print("Done after {:.1f} s.".format(time.perf_counter() - start))
 
-        print("Done.")
+    @staticmethod
+    def print_progress(refreshed_courses, count):
+        for index, (course, duration) in enumerate(refreshed_courses, 1):
+            print("[{}/{}] {} ({:.3f} s)".format(index, count, course, duration))
@@ -0,0 +1,25 @@
+from django.core.management.base import BaseCommand
+
+from evap.evaluation.tools import send_outgoing_emails
+
+import time
+
+
+class Command(BaseCommand):
+    help = 'Sends the emails in the outbox that are due, see settings.EMAIL_OUTBOX_BATCH_SIZE'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--interval', type=float,
+            help='keep running and check for due emails every INTERVAL seconds instead of checking once')
+        parser.add_argument('--batch-size', type=int, dest='batch_size', help='number of emails sent through one connection')
+
+    def handle(self, *args, **options):
+        while True:
+            while True:
+                num_sent, num_failed = send_outgoing_emails(batch_size=options['batch_size'])
+                if not num_sent and not num_failed:
+                    break
+                print("Sent {} emails, {} failed.".format(num_sent, num_failed))
+            if not options['interval']:
+                break
+            time.sleep(options['interval'])
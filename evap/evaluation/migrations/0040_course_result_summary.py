@@ -0,0 +1,31 @@
+# -*- coding: utf-8 -*-
+# Generated by Django 1.9.13 on 2026-10-18 06:03
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('evaluation', '0039_auto_20160104_1726'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='CourseResultSummary',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('average_grade', models.FloatField(blank=True, null=True, verbose_name='average grade')),
+                ('deviation', models.FloatField(blank=True, null=True, verbose_name='deviation')),
+                ('num_voters', models.IntegerField(verbose_name='number of voters')),
+                ('num_participants', models.IntegerField(verbose_name='number of participants')),
+                ('course', models.OneToOneField(on_delete=django.db.models.deletion.CASCADE, related_name='result_summary', to='evaluation.Course', verbose_name='course')),
+            ],
+            options={
+                'verbose_name': 'course result summary',
+                'verbose_name_plural': 'course result summaries',
+            },
+        ),
+    ]
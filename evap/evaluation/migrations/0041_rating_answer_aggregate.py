@@ -0,0 +1,52 @@
+# -*- coding: utf-8 -*-
+# Generated by Django 1.9.13 on 2026-10-18 06:13
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+import django.db.models.deletion
+from collections import defaultdict
+
+
+def fill_aggregates(apps, schema_editor):
+    RatingAnswerCounter = apps.get_model("evaluation", "RatingAnswerCounter")
+    RatingAnswerAggregate = apps.get_model("evaluation", "RatingAnswerAggregate")
+    aggregates = defaultdict(lambda: [0, 0, 0])
+    for contribution_id, question_id, answer, count in RatingAnswerCounter.objects.values_list('contribution_id', 'question_id', 'answer', 'count'):
+        aggregate = aggregates[(contribution_id, question_id)]
+        aggregate[0] += count
+        aggregate[1] += count * answer
+        aggregate[2] += count * answer * answer
+    RatingAnswerAggregate.objects.bulk_create(
+        RatingAnswerAggregate(contribution_id=contribution_id, question_id=question_id, count=count, sum=answer_sum, sum_of_squares=sum_of_squares)
+        for (contribution_id, question_id), (count, answer_sum, sum_of_squares) in aggregates.items()
+    )
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('evaluation', '0040_course_result_summary'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='RatingAnswerAggregate',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('count', models.IntegerField(default=0, verbose_name='count')),
+                ('sum', models.IntegerField(default=0, verbose_name='sum')),
+                ('sum_of_squares', models.IntegerField(default=0, verbose_name='sum of squares')),
+                ('contribution', models.ForeignKey(on_delete=django.db.models.deletion.PROTECT, related_name='ratingansweraggregate_set', to='evaluation.Contribution')),
+                ('question', models.ForeignKey(on_delete=django.db.models.deletion.PROTECT, to='evaluation.Question')),
+            ],
+            options={
+                'verbose_name': 'rating answer aggregate',
+                'verbose_name_plural': 'rating answer aggregates',
+            },
+        ),
+        migrations.AlterUniqueTogether(
+            name='ratingansweraggregate',
+            unique_together=set([('question', 'contribution')]),
+        ),
+        migrations.RunPython(fill_aggregates, migrations.RunPython.noop),
+    ]
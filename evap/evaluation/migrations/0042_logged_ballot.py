@@ -0,0 +1,29 @@
+# -*- coding: utf-8 -*-
+# Generated by Django 1.9.13 on 2026-10-18 06:18
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+import django.db.models.deletion
+import uuid
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('evaluation', '0041_rating_answer_aggregate'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='LoggedBallot',
+            fields=[
+                ('id', models.UUIDField(default=uuid.uuid4, editable=False, primary_key=True, serialize=False)),
+                ('answers', models.TextField(verbose_name='answers')),
+                ('course', models.ForeignKey(on_delete=django.db.models.deletion.PROTECT, to='evaluation.Course', verbose_name='course')),
+            ],
+            options={
+                'verbose_name': 'logged ballot',
+                'verbose_name_plural': 'logged ballots',
+            },
+        ),
+    ]
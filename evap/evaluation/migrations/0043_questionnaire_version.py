@@ -0,0 +1,20 @@
+# -*- coding: utf-8 -*-
+# Generated by Django 1.9.13 on 2026-10-18 06:20
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('evaluation', '0042_logged_ballot'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='questionnaire',
+            name='version',
+            field=models.IntegerField(default=0, editable=False),
+        ),
+    ]
@@ -0,0 +1,58 @@
+# -*- coding: utf-8 -*-
+# Generated by Django 1.9.13 on 2026-10-18 09:02
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+from django.db.models import Count
+
+
+def fill_participation_counts(apps, schema_editor):
+    Course = apps.get_model("evaluation", "Course")
+    # until now, only archived courses had counts
+    Course.objects.exclude(_participant_count=None).update(is_archived=True)
+
+    participant_counts = dict(Course.participants.through.objects.values_list('course_id').annotate(Count('id')).order_by())
+    voter_counts = dict(Course.voters.through.objects.values_list('course_id').annotate(Count('id')).order_by())
+    for course_id in Course.objects.filter(is_archived=False).values_list('pk', flat=True):
+        Course.objects.filter(pk=course_id).update(_participant_count=participant_counts.get(course_id, 0), _voter_count=voter_counts.get(course_id, 0))
+
+
+def clear_participation_counts(apps, schema_editor):
+    Course = apps.get_model("evaluation", "Course")
+    Course.objects.filter(is_archived=False).update(_participant_count=None, _voter_count=None)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('evaluation', '0043_questionnaire_version'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='course',
+            name='is_archived',
+            field=models.BooleanField(default=False, editable=False, verbose_name='is archived'),
+        ),
+        migrations.AlterField(
+            model_name='course',
+            name='_participant_count',
+            field=models.IntegerField(blank=True, default=None, editable=False, null=True, verbose_name='participant count'),
+        ),
+        migrations.AlterField(
+            model_name='course',
+            name='_voter_count',
+            field=models.IntegerField(blank=True, default=None, editable=False, null=True, verbose_name='voter count'),
+        ),
+        migrations.RunPython(fill_participation_counts, reverse_code=clear_participation_counts),
+        migrations.AlterField(
+            model_name='course',
+            name='_participant_count',
+            field=models.IntegerField(default=0, editable=False, verbose_name='participant count'),
+        ),
+        migrations.AlterField(
+            model_name='course',
+            name='_voter_count',
+            field=models.IntegerField(default=0, editable=False, verbose_name='voter count'),
+        ),
+    ]
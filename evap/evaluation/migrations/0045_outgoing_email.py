@@ -0,0 +1,40 @@
+# -*- coding: utf-8 -*-
+# Generated by Django 1.9.13 on 2026-10-18 06:35
+from __future__ import unicode_literals
+
+import datetime
+from django.conf import settings
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('evaluation', '0044_live_participation_counts'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='OutgoingEmail',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('subject', models.TextField(verbose_name='subject')),
+                ('body', models.TextField(verbose_name='body')),
+                ('to', models.CharField(max_length=255, verbose_name='to')),
+                ('cc', models.TextField(default='[]', verbose_name='cc')),
+                ('bcc', models.TextField(default='[]', verbose_name='bcc')),
+                ('created_time', models.DateTimeField(auto_now_add=True, verbose_name='created')),
+                ('sent_time', models.DateTimeField(blank=True, null=True, verbose_name='sent')),
+                ('attempts', models.IntegerField(default=0, verbose_name='failed attempts')),
+                ('next_attempt_time', models.DateTimeField(default=datetime.datetime.now, verbose_name='next attempt')),
+                ('last_error', models.TextField(blank=True, verbose_name='last error')),
+                ('user', models.ForeignKey(blank=True, null=True, on_delete=django.db.models.deletion.SET_NULL, related_name='+', to=settings.AUTH_USER_MODEL, verbose_name='user')),
+            ],
+            options={
+                'verbose_name': 'outgoing email',
+                'verbose_name_plural': 'outgoing emails',
+                'ordering': ('-created_time', '-id'),
+            },
+        ),
+    ]
@@ -0,0 +1,29 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import migrations
+from django.db.models import Min
+
+
+def remove_duplicate_voters(apps, schema_editor):
+    Course = apps.get_model("evaluation", "Course")
+    Voters = Course.voters.through
+    kept_ids = Voters.objects.values('course_id', 'userprofile_id').annotate(first_id=Min('id')).order_by().values_list('first_id', flat=True)
+    Voters.objects.exclude(id__in=list(kept_ids)).delete()
+
+
+class Migration(migrations.Migration):
+    # the voters table was created without the unique index of the m2m relation, which the vote view relies on
+    # to reject a second vote of a user that happens concurrently
+
+    dependencies = [
+        ('evaluation', '0045_outgoing_email'),
+    ]
+
+    operations = [
+        migrations.RunPython(remove_duplicate_voters, reverse_code=migrations.RunPython.noop),
+        migrations.RunSQL(
+            ["CREATE UNIQUE INDEX evaluation_course_voters_unique_vote ON evaluation_course_voters (course_id, userprofile_id)"],
+            reverse_sql=["DROP INDEX evaluation_course_voters_unique_vote"],
+        ),
+    ]
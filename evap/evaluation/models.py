@@ -1,8 +1,10 @@
 from django.conf import settings
 from django.core.exceptions import ValidationError
 from django.core.mail import EmailMessage
-from django.db import models
+from django.db import connection, models, transaction
 from django.db.models import Count
+from django.db.models.expressions import RawSQL
+from django.db.models.signals import post_save, post_delete, pre_delete, m2m_changed
 from django.dispatch import receiver
 from django.utils.translation import ugettext_lazy as _
 from django.utils.functional import cached_property
@@ -16,8 +18,13 @@ from django.contrib.auth.models import AbstractBaseUser, BaseUserManager, Permis
 # see evaluation.meta for the use of Translate in this file
 from evap.evaluation.meta import LocalizeModelBase, Translate
 
+from collections import OrderedDict, defaultdict
 import datetime
+import hashlib
+import json
+import math
 import random
+import uuid
 import logging
 
 logger = logging.getLogger(__name__)
@@ -113,6 +120,10 @@ class Questionnaire(models.Model, metaclass=LocalizeModelBase):
     staff_only = models.BooleanField(verbose_name=_("display for staff only"), default=False)
     obsolete = models.BooleanField(verbose_name=_("obsolete"), default=False)
 
+    # set to a new random value whenever the questionnaire or its questions change, see student.forms.get_field_specs.
+    # unlike a counter this can't repeat after restoring a backup or with reused ids in tests
+    version = models.IntegerField(default=0, editable=False)
+
     class Meta:
         ordering = ('is_for_contributors', 'index', 'name_de')
         verbose_name = _("questionnaire")
@@ -192,11 +203,15 @@ class Course(models.Model, metaclass=LocalizeModelBase):
 
     # students that are allowed to vote
     participants = models.ManyToManyField(settings.AUTH_USER_MODEL, verbose_name=_("participants"), blank=True)
-    _participant_count = models.IntegerField(verbose_name=_("participant count"), blank=True, null=True, default=None)
+    # kept up to date by update_participation_counts and the vote view, see check_participation_counts for repairing them
+    _participant_count = models.IntegerField(verbose_name=_("participant count"), default=0, editable=False)
 
     # students that already voted
     voters = models.ManyToManyField(settings.AUTH_USER_MODEL, verbose_name=_("voters"), blank=True, related_name='+')
-    _voter_count = models.IntegerField(verbose_name=_("voter count"), blank=True, null=True, default=None)
+    _voter_count = models.IntegerField(verbose_name=_("voter count"), default=0, editable=False)
+
+    # the participation counts of archived courses don't change anymore, e.g. when users are deleted
+    is_archived = models.BooleanField(verbose_name=_("is archived"), default=False, editable=False)
 
     # when the evaluation takes place
     vote_start_date = models.DateField(verbose_name=_("first day of evaluation"))
@@ -235,6 +250,9 @@ class Course(models.Model, metaclass=LocalizeModelBase):
     def is_not_fully_reviewed(self):
         return self.open_textanswer_set.exists()
 
+    def is_ballot_log_processed(self):
+        return not self.loggedballot_set.exists()
+
     def is_in_evaluation_period(self):
         today = datetime.date.today()
         return today >= self.vote_start_date and today <= self.vote_end_date
@@ -242,12 +260,18 @@ class Course(models.Model, metaclass=LocalizeModelBase):
     def has_enough_questionnaires(self):
         return self.general_contribution and (self.is_single_result() or all(self.contributions.annotate(Count('questionnaires')).values_list("questionnaires__count", flat=True)))
 
+    def is_participant(self, user):
+        return self.participants.filter(pk=user.pk).exists()
+
+    def has_voted(self, user):
+        return self.voters.filter(pk=user.pk).exists()
+
     def can_user_vote(self, user):
         """Returns whether the user is allowed to vote on this course."""
         return (self.state == "inEvaluation"
             and self.is_in_evaluation_period
-            and user in self.participants.all()
-            and user not in self.voters.all())
+            and self.is_participant(user)
+            and not self.has_voted(user))
 
     def can_user_see_results(self, user):
         if user.is_staff:
@@ -307,7 +331,7 @@ class Course(models.Model, metaclass=LocalizeModelBase):
     def reopen_evaluation(self):
         pass
 
-    @transition(field=state, source='inEvaluation', target='evaluated')
+    @transition(field=state, source='inEvaluation', target='evaluated', conditions=[is_ballot_log_processed])
     def evaluation_end(self):
         pass
 
@@ -344,15 +368,11 @@ class Course(models.Model, metaclass=LocalizeModelBase):
 
     @cached_property
     def num_participants(self):
-        if self._participant_count is not None:
-            return self._participant_count
-        return self.participants.count()
+        return self._participant_count
 
     @cached_property
     def num_voters(self):
-        if self._voter_count is not None:
-            return self._voter_count
-        return self.voters.count()
+        return self._voter_count
 
     @property
     def due_participants(self):
@@ -441,15 +461,9 @@ class Course(models.Model, metaclass=LocalizeModelBase):
         """Should be called only via Semester.archive"""
         if not self.is_archiveable:
             raise NotArchiveable()
-        self._participant_count = self.participants.count()
-        self._voter_count = self.voters.count()
+        self.is_archived = True
         self.save()
 
-    @property
-    def is_archived(self):
-        assert((self._participant_count is None) == (self._voter_count is None))
-        return self._participant_count is not None
-
     @property
     def is_archiveable(self):
         return not self.is_archived and self.state in ["new", "published"]
@@ -482,7 +496,7 @@ class Course(models.Model, metaclass=LocalizeModelBase):
                     course.evaluation_begin()
                     course.save()
                     courses_new_in_evaluation.append(course)
-                elif course.state == "inEvaluation" and course.vote_end_date < today:
+                elif course.state == "inEvaluation" and course.vote_end_date < today and course.is_ballot_log_processed():
                     course.evaluation_end()
                     if course.is_fully_reviewed():
                         course.review_finished()
@@ -633,8 +647,43 @@ class RatingAnswerCounter(Answer):
         verbose_name = _("rating answer")
         verbose_name_plural = _("rating answers")
 
-    def add_vote(self):
-        self.count += 1
+
+class RatingAnswerAggregate(models.Model):
+    """The number, sum and sum of squares of all rating answers given to a
+    question for a contribution. It is updated with every vote alongside the
+    `RatingAnswerCounter`s, so the statistics of a question can be read without
+    aggregating the counters. See evaluation.tools.rebuild_rating_answer_aggregates."""
+
+    question = models.ForeignKey(Question, models.PROTECT)
+    contribution = models.ForeignKey(Contribution, models.PROTECT, related_name="ratingansweraggregate_set")
+    count = models.IntegerField(verbose_name=_("count"), default=0)
+    sum = models.IntegerField(verbose_name=_("sum"), default=0)
+    sum_of_squares = models.IntegerField(verbose_name=_("sum of squares"), default=0)
+
+    class Meta:
+        unique_together = (
+            ('question', 'contribution'),
+        )
+        verbose_name = _("rating answer aggregate")
+        verbose_name_plural = _("rating answer aggregates")
+
+    @property
+    def total_count(self):
+        return self.count
+
+    @property
+    def average(self):
+        if self.count == 0:
+            return None
+        return self.sum / self.count
+
+    @property
+    def deviation(self):
+        """The population standard deviation of the answers."""
+        if self.count == 0:
+            return None
+        # rounding errors might make the variance slightly negative
+        return math.sqrt(max(self.sum_of_squares / self.count - self.average ** 2, 0))
 
 
 class TextAnswer(Answer):
@@ -691,6 +740,166 @@ class TextAnswer(Answer):
         self.state = self.NOT_REVIEWED
 
 
+class LoggedBallot(models.Model):
+    """The answers of one vote that have not been added to the answer counters
+    and text answers yet, see settings.DEFERRED_VOTE_AGGREGATION and
+    evaluation.tools.process_ballot_log. Like answers, it doesn't store who
+    voted or when.
+
+    Unlike the answer counters, a ballot holds all answers of one voter. Its
+    primary key is random, so ballots can't be matched to the voters of a
+    course by their order. The database might still store the rows in the
+    order they were written (e.g. SQLite's rowid), which is why the log should
+    be processed often."""
+
+    id = models.UUIDField(primary_key=True, default=uuid.uuid4, editable=False)
+    course = models.ForeignKey(Course, models.PROTECT, verbose_name=_("course"))
+    # a JSON object with the lists "rating_answers" and "text_answers", see evaluation.tools.add_answers
+    answers = models.TextField(verbose_name=_("answers"))
+
+    class Meta:
+        verbose_name = _("logged ballot")
+        verbose_name_plural = _("logged ballots")
+
+
+class CourseResultSummary(models.Model):
+    """The final results of a course as shown in course listings. They are
+    stored so that listings don't have to calculate the full results of every
+    course. See evaluation.tools.update_result_summary."""
+
+    # the states in which courses have a summary
+    COURSE_STATES = ['evaluated', 'reviewed', 'published']
+
+    course = models.OneToOneField(Course, models.CASCADE, verbose_name=_("course"), related_name="result_summary")
+    average_grade = models.FloatField(verbose_name=_("average grade"), blank=True, null=True)
+    deviation = models.FloatField(verbose_name=_("deviation"), blank=True, null=True)
+    num_voters = models.IntegerField(verbose_name=_("number of voters"))
+    num_participants = models.IntegerField(verbose_name=_("number of participants"))
+
+    class Meta:
+        verbose_name = _("course result summary")
+        verbose_name_plural = _("course result summaries")
+
+
+@receiver(post_transition, sender=Course)
+def update_results_on_state_change(sender, instance, source, target, **kwargs):
+    from evap.evaluation.tools import invalidate_results, update_result_summary
+    # the results only depend on the answers, which don't change between these states
+    if (source in CourseResultSummary.COURSE_STATES) == (target in CourseResultSummary.COURSE_STATES):
+        return
+    invalidate_results([instance.id])
+    if target in CourseResultSummary.COURSE_STATES:
+        update_result_summary(instance)
+    else:
+        CourseResultSummary.objects.filter(course=instance).delete()
+
+
+@receiver(post_save, sender=TextAnswer)
+@receiver(post_delete, sender=TextAnswer)
+@receiver(post_save, sender=RatingAnswerCounter)
+@receiver(post_delete, sender=RatingAnswerCounter)
+def update_results_on_answer_change(sender, instance, raw=False, **kwargs):
+    from evap.evaluation.tools import invalidate_results, update_result_summary, rebuild_rating_answer_aggregates
+    if raw:
+        # loading fixtures, related objects might not exist yet
+        return
+    course = instance.contribution.course
+    if sender == RatingAnswerCounter:
+        # votes update the aggregates themselves, see evaluation.tools.add_answers
+        rebuild_rating_answer_aggregates(Contribution.objects.filter(pk=instance.contribution_id))
+    invalidate_results([course.id])
+    # text answers don't influence the summary
+    if sender == RatingAnswerCounter and course.state in CourseResultSummary.COURSE_STATES:
+        update_result_summary(course)
+
+
+def _update_results_of_courses(course_ids):
+    """Invalidates the cached results of the given courses and updates their
+    result summaries, e.g. after staff changed their contributions."""
+    from evap.evaluation.tools import invalidate_results, update_result_summaries
+    course_ids = set(course_ids)
+    invalidate_results(course_ids)
+    update_result_summaries(course_ids)
+
+
+@receiver(post_save, sender=Contribution)
+@receiver(post_delete, sender=Contribution)
+def update_results_on_contribution_change(sender, instance, raw=False, **kwargs):
+    if not raw:
+        _update_results_of_courses([instance.course_id])
+
+
+@receiver(m2m_changed, sender=Contribution.questionnaires.through)
+def update_results_on_contribution_questionnaires_change(sender, instance, action, reverse, pk_set, **kwargs):
+    if reverse and action == 'pre_clear':
+        # instance is a questionnaire whose contributions are not known anymore after clearing
+        instance._cleared_course_ids = list(Contribution.objects.filter(questionnaires=instance).values_list('course_id', flat=True))
+        return
+    if action not in ('post_add', 'post_remove', 'post_clear'):
+        return
+    if not reverse:
+        _update_results_of_courses([instance.course_id])
+    elif action == 'post_clear':
+        _update_results_of_courses(instance._cleared_course_ids)
+    else:
+        _update_results_of_courses(Contribution.objects.filter(pk__in=pk_set).values_list('course_id', flat=True))
+
+
+@receiver(post_save, sender=Questionnaire)
+@receiver(post_save, sender=Question)
+@receiver(post_delete, sender=Question)
+def update_results_on_questionnaire_change(sender, instance, raw=False, **kwargs):
+    if raw:
+        return
+    questionnaire_id = instance.id if sender == Questionnaire else instance.questionnaire_id
+    _update_results_of_courses(Contribution.objects.filter(questionnaires=questionnaire_id).values_list('course_id', flat=True))
+
+
+@receiver(post_save, sender=Questionnaire)
+@receiver(post_save, sender=Question)
+@receiver(post_delete, sender=Question)
+def change_questionnaire_version(sender, instance, raw=False, **kwargs):
+    if raw:
+        return
+    questionnaire_id = instance.id if sender == Questionnaire else instance.questionnaire_id
+    Questionnaire.objects.filter(pk=questionnaire_id).update(version=random.randint(1, 2**31 - 1))
+
+
+@receiver(m2m_changed, sender=Course.participants.through)
+@receiver(m2m_changed, sender=Course.voters.through)
+def update_participation_counts(sender, instance, action, reverse, pk_set, **kwargs):
+    if reverse and action == 'pre_clear':
+        # instance is a user whose courses are not known anymore after clearing
+        instance._cleared_course_ids = list(instance.course_set.values_list('pk', flat=True))
+        return
+    if action not in ('post_add', 'post_remove', 'post_clear'):
+        return
+
+    if not reverse:
+        course_ids = [instance.pk]
+    elif action == 'post_clear':
+        course_ids = instance._cleared_course_ids
+    else:
+        course_ids = pk_set
+
+    count_field = '_participant_count' if sender == Course.participants.through else '_voter_count'
+    # the related objects are counted again instead of adding len(pk_set). pk_set might contain objects that were
+    # not related, and loading fixtures adds all participants and voters to courses that have their counts already
+    count = RawSQL('SELECT COUNT(*) FROM {0} WHERE {0}.course_id = {1}.id'.format(
+        connection.ops.quote_name(sender._meta.db_table), connection.ops.quote_name(Course._meta.db_table)), [])
+    Course.objects.filter(pk__in=course_ids, is_archived=False).update(**{count_field: count})
+
+    if not reverse:
+        setattr(instance, count_field, Course.objects.values_list(count_field, flat=True).get(pk=instance.pk))
+        instance.__dict__.pop('num_participants' if count_field == '_participant_count' else 'num_voters', None)
+
+    # only the counts change, existing summaries are updated in place
+    for summary in CourseResultSummary.objects.filter(course_id__in=course_ids).select_related('course'):
+        summary.num_voters = summary.course.num_voters
+        summary.num_participants = summary.course.num_participants
+        summary.save()
+
+
 class FaqSection(models.Model, metaclass=LocalizeModelBase):
     """Section in the frequently asked questions"""
 
@@ -909,6 +1118,17 @@ class UserProfile(AbstractBaseUser, PermissionsMixin):
     def refresh_login_key(self):
         self.login_key_valid_until = datetime.date.today() + datetime.timedelta(settings.LOGIN_KEY_VALIDITY)
 
+
+@receiver(pre_delete, sender=UserProfile)
+def update_participation_counts_on_user_delete(sender, instance, **kwargs):
+    # deleting a user removes them from their courses without sending m2m_changed
+    Course.objects.filter(participants=instance, is_archived=False).update(_participant_count=models.F('_participant_count') - 1)
+    Course.objects.filter(voters=instance, is_archived=False).update(_voter_count=models.F('_voter_count') - 1)
+
+# maps (email template id, field name) to the hash of the field and its compiled Template, see EmailTemplate.render
+_compiled_email_templates = {}
+
+
 def validate_template(value):
     """Field validator which ensures that the value can be compiled into a
     Django Template."""
@@ -941,78 +1161,123 @@ class EmailTemplate(models.Model):
     )
 
 
+    def __compiled(self, field):
+        text = getattr(self, field)
+        if self.id is None:
+            # unsaved templates like the ones of CourseEmailForm are used once
+            return Template(text)
+        text_hash = hashlib.sha1(text.encode()).hexdigest()
+        cached_hash, template = _compiled_email_templates.get((self.id, field), (None, None))
+        if cached_hash != text_hash:
+            template = Template(text)
+            _compiled_email_templates[(self.id, field)] = (text_hash, template)
+        return template
+
+    def render(self, subject_params, body_params):
+        """Returns the rendered subject and body. The compiled templates are
+        reused as long as the subject and body don't change."""
+        subject = self.__compiled('subject').render(Context(subject_params, autoescape=False))
+        body = self.__compiled('body').render(Context(body_params, autoescape=False))
+        return subject, body
+
     @classmethod
-    def recipient_list_for_course(cls, course, recipient_groups):
-        recipients = []
+    def recipients_for_courses(cls, courses, recipient_groups):
+        """Returns an ordered dict mapping the recipients of the courses to their courses.
+        Loads the whole course set with a fixed number of queries."""
+        course_ids = [course.id for course in courses]
+        users = {}
+        recipient_ids = defaultdict(list)
+        responsible_ids = {}
+
+        for contribution in Contribution.objects.filter(course_id__in=course_ids).exclude(contributor=None).select_related('contributor'):
+            users.setdefault(contribution.contributor_id, contribution.contributor)
+            if contribution.responsible:
+                responsible_ids[contribution.course_id] = contribution.contributor_id
+            if "contributors" in recipient_groups or ("editors" in recipient_groups and contribution.can_edit):
+                recipient_ids[contribution.course_id].append(contribution.contributor_id)
 
         if "responsible" in recipient_groups:
-            recipients += [course.responsible_contributor]
-
-        if "contributors" in recipient_groups:
-            recipients += [c.contributor for c in course.contributions.exclude(contributor=None)]
-        elif "editors" in recipient_groups:
-            recipients += [c.contributor for c in course.contributions.exclude(contributor=None).filter(can_edit=True)]
-
-        if "all_participants" in recipient_groups:
-            recipients += course.participants.all()
-        elif "due_participants" in recipient_groups:
-            recipients += course.due_participants
-
+            for course_id, responsible_id in responsible_ids.items():
+                recipient_ids[course_id].append(responsible_id)
+
+        if "all_participants" in recipient_groups or "due_participants" in recipient_groups:
+            votes = set()
+            if "all_participants" not in recipient_groups:
+                votes = set(Course.voters.through.objects.filter(course_id__in=course_ids).values_list('course_id', 'userprofile_id'))
+            for participation in Course.participants.through.objects.filter(course_id__in=course_ids).select_related('userprofile'):
+                if (participation.course_id, participation.userprofile_id) not in votes:
+                    users.setdefault(participation.userprofile_id, participation.userprofile)
+                    recipient_ids[participation.course_id].append(participation.userprofile_id)
+
+        # users who get the responsible's emails in cc don't need their own
+        cc_user_ids = defaultdict(set)
+        for relation in (UserProfile.delegates.through, UserProfile.cc_users.through):
+            for user_id, cc_user_id in relation.objects.filter(from_userprofile_id__in=responsible_ids.values()).values_list('from_userprofile_id', 'to_userprofile_id'):
+                cc_user_ids[user_id].add(cc_user_id)
+
+        recipients = OrderedDict()
+        for course in courses:
+            excluded_ids = cc_user_ids[responsible_ids.get(course.id)]
+            for user_id in recipient_ids[course.id]:
+                if user_id not in excluded_ids:
+                    user_courses = recipients.setdefault(users[user_id], [])
+                    if course not in user_courses:
+                        user_courses.append(course)
         return recipients
 
-
     @classmethod
-    def __render_string(cls, text, dictionary):
-        return Template(text).render(Context(dictionary, autoescape=False))
+    @transaction.atomic
+    def send_to_users_in_courses(cls, template, courses, recipient_groups):
+        recipients = cls.recipients_for_courses(courses, recipient_groups)
+        cc_addresses = cls.get_cc_addresses(recipients.keys())
 
-    @classmethod
-    def send_to_users_in_courses(self, template, courses, recipient_groups):
-        user_course_map = {}
-        for course in courses:
-            responsible = course.responsible_contributor
-            for user in self.recipient_list_for_course(course, recipient_groups):
-                if user not in responsible.cc_users.all() and user not in responsible.delegates.all():
-                    user_course_map.setdefault(user, []).append(course)
-
-        for user, courses in user_course_map.items():
+        for user, courses in recipients.items():
             subject_params = {}
             body_params = {'user': user, 'courses': courses}
-            self.__send_to_user(user, template, subject_params, body_params, cc=True)
+            cls.__send_to_user(user, template, subject_params, body_params, cc=True, cc_addresses=cc_addresses[user.id])
 
 
     @classmethod
-    def __send_to_user(cls, user, template, subject_params, body_params, cc):
+    def __send_to_user(cls, user, template, subject_params, body_params, cc, cc_addresses=None):
+        """Puts the email into the outbox, see OutgoingEmail. Returns the OutgoingEmail or None.
+        If cc is set, the delegates and CC users of the user are loaded unless cc_addresses are given."""
         if not user.email:
             logger.warning("{} has no email address defined. Could not send email.".format(user.username))
-            return
+            return None
 
-        if cc:
-            cc_users = set(user.delegates.all() | user.cc_users.all())
-            cc_addresses = [p.email for p in cc_users if p.email]
-        else:
+        if not cc:
             cc_addresses = []
+        elif cc_addresses is None:
+            cc_addresses = cls.get_cc_addresses([user])[user.id]
 
-        subject = cls.__render_string(template.subject, subject_params)
-        body = cls.__render_string(template.body, body_params)
+        subject, body = template.render(subject_params, body_params)
 
-        mail = EmailMessage(
+        email = OutgoingEmail.objects.create(
+            user = user,
             subject = subject,
             body = body,
-            to = [user.email],
-            cc = cc_addresses,
-            bcc = [a[1] for a in settings.MANAGERS],
-            headers = {'Reply-To': settings.REPLY_TO_EMAIL})
-
-        try:
-            mail.send(False)
-            logger.info(('Sent email "{}" to {}.').format(subject, user.username))
-        except Exception:
-            logger.exception('An exception occurred when sending the following email to user "{}":\n{}\n'.format(user.username, mail.message()))
-
+            to = user.email,
+            cc = json.dumps(cc_addresses),
+            bcc = json.dumps([a[1] for a in settings.MANAGERS]))
+        logger.info(('Queued email "{}" to {}.').format(subject, user.username))
+        return email
+
+
+    @staticmethod
+    def get_cc_addresses(users):
+        """Returns a dict mapping the ids of the users to the sorted email addresses of their delegates and CC users."""
+        user_ids = [user.id for user in users]
+        cc_addresses = {user_id: set() for user_id in user_ids}
+        for relation in (UserProfile.delegates.through, UserProfile.cc_users.through):
+            for user_id, email in relation.objects.filter(from_userprofile_id__in=user_ids).values_list('from_userprofile_id', 'to_userprofile__email'):
+                if email:
+                    cc_addresses[user_id].add(email)
+        return {user_id: sorted(emails) for user_id, emails in cc_addresses.items()}
 
     @classmethod
-    def send_reminder_to_user(cls, user, first_due_in_days, due_courses):
-        template = cls.objects.get(name=cls.STUDENT_REMINDER)
+    def send_reminder_to_user(cls, user, first_due_in_days, due_courses, template=None):
+        if template is None:
+            template = cls.objects.get(name=cls.STUDENT_REMINDER)
         subject_params = {'user': user, 'first_due_in_days': first_due_in_days}
         body_params = {'user': user, 'first_due_in_days': first_due_in_days, 'due_courses': due_courses}
 
@@ -1024,11 +1289,17 @@ class EmailTemplate(models.Model):
         subject_params = {}
         body_params = {'user': user}
 
-        cls.__send_to_user(user, template, subject_params, body_params, cc=False)
+        email = cls.__send_to_user(user, template, subject_params, body_params, cc=False)
+        # the user is waiting for the key
+        if email:
+            from evap.evaluation.tools import send_outgoing_emails
+            send_outgoing_emails([email])
 
     @classmethod
-    def send_publish_notifications_to_user(cls, user, grade_document_courses=[], evaluation_results_courses=[]):
-        template = cls.objects.get(name=cls.PUBLISHING_NOTICE)
+    def send_publish_notifications_to_user(cls, user, grade_document_courses=[], evaluation_results_courses=[], template=None, cc_addresses=None):
+        """The template and the CC addresses can be passed to save their queries when notifying many users."""
+        if template is None:
+            template = cls.objects.get(name=cls.PUBLISHING_NOTICE)
 
         grade_documents_exist = len(grade_document_courses) > 0
         evaluation_results_exist = len(evaluation_results_courses) > 0
@@ -1045,7 +1316,7 @@ class EmailTemplate(models.Model):
                 'evaluation_results_courses': evaluation_results_courses
             }
 
-        cls.__send_to_user(user, template, subject_params, body_params, cc=True)
+        cls.__send_to_user(user, template, subject_params, body_params, cc=True, cc_addresses=cc_addresses)
 
     @classmethod
     def send_review_notifications(cls, courses):
@@ -1056,3 +1327,58 @@ class EmailTemplate(models.Model):
     def send_evaluation_started_notifications(cls, courses):
         template = cls.objects.get(name=cls.EVALUATION_STARTED)
         cls.send_to_users_in_courses(template, courses, ['all_participants'])
+
+
+@receiver(post_save, sender=EmailTemplate)
+@receiver(post_delete, sender=EmailTemplate)
+def forget_compiled_email_template(sender, instance, **kwargs):
+    # changed templates are compiled again anyway, this only frees the memory in this process
+    for field in ('subject', 'body'):
+        _compiled_email_templates.pop((instance.id, field), None)
+
+
+class OutgoingEmail(models.Model):
+    """An email in the outbox. Emails are sent by the send_outgoing_emails
+    command, so sending many emails doesn't slow down requests."""
+
+    user = models.ForeignKey(settings.AUTH_USER_MODEL, models.SET_NULL, verbose_name=_("user"), null=True, blank=True, related_name='+')
+    subject = models.TextField(verbose_name=_("subject"))
+    body = models.TextField(verbose_name=_("body"))
+    to = models.CharField(max_length=255, verbose_name=_("to"))
+    # JSON lists of addresses
+    cc = models.TextField(verbose_name=_("cc"), default="[]")
+    bcc = models.TextField(verbose_name=_("bcc"), default="[]")
+
+    created_time = models.DateTimeField(verbose_name=_("created"), auto_now_add=True)
+    sent_time = models.DateTimeField(verbose_name=_("sent"), null=True, blank=True)
+    attempts = models.IntegerField(verbose_name=_("failed attempts"), default=0)
+    next_attempt_time = models.DateTimeField(verbose_name=_("next attempt"), default=datetime.datetime.now)
+    last_error = models.TextField(verbose_name=_("last error"), blank=True)
+
+    class Meta:
+        ordering = ('-created_time', '-id')
+        verbose_name = _("outgoing email")
+        verbose_name_plural = _("outgoing emails")
+
+    @classmethod
+    def pending(cls):
+        return cls.objects.filter(sent_time=None, attempts__lt=settings.EMAIL_OUTBOX_MAX_ATTEMPTS)
+
+    @classmethod
+    def failed(cls):
+        """Emails that won't be tried again"""
+        return cls.objects.filter(sent_time=None, attempts__gte=settings.EMAIL_OUTBOX_MAX_ATTEMPTS)
+
+    @property
+    def is_failed(self):
+        return self.sent_time is None and self.attempts >= settings.EMAIL_OUTBOX_MAX_ATTEMPTS
+
+    def message(self, connection=None):
+        return EmailMessage(
+            subject = self.subject,
+            body = self.body,
+            to = [self.to],
+            cc = json.loads(self.cc),
+            bcc = json.loads(self.bcc),
+            headers = {'Reply-To': settings.REPLY_TO_EMAIL},
+            connection = connection)
@@ -0,0 +1,54 @@
+from django.conf import settings
+
+from collections import OrderedDict
+from math import sqrt
+from statistics import median
+
+# Statistics for rating questions, computed directly from count histograms.
+# A histogram is a mapping from each answer (1 to 5) to the number of people
+# who gave that answer, which is exactly what the RatingAnswerCounters of a
+# question store. All functions run in O(number of answers) instead of
+# expanding the histogram into one list element per vote.
+
+RATING_ANSWERS = range(1, 6)
+
+
+def empty_histogram():
+    return OrderedDict((answer, 0) for answer in RATING_ANSWERS)
+
+
+def total_count(counts):
+    return sum(counts.values())
+
+
+def average(counts):
+    """Returns the arithmetic mean of the answers or `None` if there are none."""
+    count = total_count(counts)
+    if count == 0:
+        return None
+    return sum(answer * answer_count for answer, answer_count in counts.items()) / count
+
+
+def deviation(counts, mean=None):
+    """Returns the population standard deviation of the answers or `None` if
+    there are none. Pass `mean` if it is already known to save one pass."""
+    count = total_count(counts)
+    if count == 0:
+        return None
+    if mean is None:
+        mean = average(counts)
+    variance = sum(answer_count * (answer - mean) ** 2 for answer, answer_count in counts.items()) / count
+    return sqrt(variance)
+
+
+def calculate_rating_statistics(counts):
+    """Returns a tuple of the total count, average and deviation of the answers."""
+    mean = average(counts)
+    return total_count(counts), mean, deviation(counts, mean)
+
+
+def warning_threshold(max_answer_counts):
+    """Results with less answers than the returned value get a warning. The
+    threshold is a percentage of the median of the maximum number of answers
+    given to any question of each section, see RESULTS_WARNING_PERCENTAGE."""
+    return settings.RESULTS_WARNING_PERCENTAGE * median(max_answer_counts)
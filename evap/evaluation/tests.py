@@ -1,10 +1,23 @@
 from django_webtest import WebTest
 from django.core import mail
+from django.core.cache import cache
 from django.contrib.auth.hashers import make_password
-from evap.evaluation.models import UserProfile
+from django.core.mail.backends.base import BaseEmailBackend
+from django.core.management import call_command
+from django.template import Template
+from django.test import TestCase, override_settings
+from evap.evaluation.models import UserProfile, Course, Contribution, EmailTemplate, OutgoingEmail, _compiled_email_templates
+from evap.evaluation.rating_statistics import empty_histogram, calculate_rating_statistics, warning_threshold
+from evap.evaluation.tools import avg, send_outgoing_emails, send_publish_notifications, get_publish_notification_recipients, \
+                                  get_due_reminders
 from model_mommy import mommy
 
-from datetime import date, timedelta
+from datetime import date, datetime, timedelta
+from smtplib import SMTPException
+from statistics import pstdev, median
+from unittest.mock import patch
+import json
+import random
 
 
 class LoginTests(WebTest):
@@ -49,3 +62,271 @@ class LoginTests(WebTest):
         self.assertEqual(len(mail.outbox), 1)
         self.assertTrue(mail.outbox[0].to == [email])
         self.assertEqual(len(mail.outbox[0].cc), 0)
+
+
+class EmailTemplateTests(TestCase):
+    def test_compiled_templates_are_cached(self):
+        template = mommy.make(EmailTemplate, subject="Hello {{ user }}", body="Goodbye {{ user }}")
+        with patch('evap.evaluation.models.Template', wraps=Template) as template_mock:
+            self.assertEqual(template.render({'user': "Jane"}, {'user': "Jane"}), ("Hello Jane", "Goodbye Jane"))
+            self.assertEqual(template.render({'user': "John"}, {'user': "John"}), ("Hello John", "Goodbye John"))
+            self.assertEqual(template_mock.call_count, 2)
+
+            template.subject = "Hi {{ user }}"
+            template.save()
+            self.assertEqual(template.render({'user': "Jane"}, {'user': "Jane"}), ("Hi Jane", "Goodbye Jane"))
+            self.assertEqual(template_mock.call_count, 4)
+
+    def test_unsaved_templates_are_not_cached(self):
+        number_of_compiled_templates = len(_compiled_email_templates)
+        for i in range(3):
+            template = EmailTemplate(subject="Hello {{ user }} " + str(i), body="Goodbye {{ user }}")
+            self.assertEqual(template.render({'user': "Jane"}, {'user': "Jane"}), ("Hello Jane " + str(i), "Goodbye Jane"))
+        self.assertEqual(len(_compiled_email_templates), number_of_compiled_templates)
+
+    def test_changed_unsaved_text_replaces_the_cached_template(self):
+        template = mommy.make(EmailTemplate, subject="Hello", body="Goodbye")
+        for i in range(3):
+            template.subject = "Hello " + str(i)
+            template.render({}, {})
+        self.assertEqual(len([key for key in _compiled_email_templates if key[0] == template.id]), 2)
+
+
+class FailingEmailBackend(BaseEmailBackend):
+    def send_messages(self, email_messages):
+        raise SMTPException("The mail server is unavailable")
+
+
+class UnreachableEmailBackend(BaseEmailBackend):
+    def open(self):
+        raise ConnectionRefusedError()
+
+
+class OutgoingEmailTests(TestCase):
+    def setUp(self):
+        self.users = mommy.make(UserProfile, email=iter(["{}@example.com".format(i) for i in range(3)]), _quantity=3)
+        for user in self.users:
+            EmailTemplate.send_reminder_to_user(user, first_due_in_days=1, due_courses=[])
+
+    def test_emails_are_sent_from_the_outbox(self):
+        self.assertEqual(len(mail.outbox), 0)
+        self.assertEqual(OutgoingEmail.pending().count(), 3)
+
+        self.assertEqual(send_outgoing_emails(batch_size=2), (2, 0))
+        self.assertEqual(send_outgoing_emails(batch_size=2), (1, 0))
+        self.assertEqual(send_outgoing_emails(batch_size=2), (0, 0))
+
+        self.assertEqual(sorted(email.to[0] for email in mail.outbox), [user.email for user in self.users])
+        self.assertFalse(OutgoingEmail.pending().exists())
+
+    def test_emails_claimed_by_another_process_are_skipped(self):
+        emails = list(OutgoingEmail.pending())
+        # another process claims or sends the first two emails after they were loaded
+        OutgoingEmail.objects.filter(id=emails[0].id).update(next_attempt_time=datetime.now() + timedelta(minutes=10))
+        OutgoingEmail.objects.filter(id=emails[1].id).update(sent_time=datetime.now())
+
+        self.assertEqual(send_outgoing_emails(emails), (1, 0))
+        self.assertEqual(send_outgoing_emails(), (0, 0))
+        self.assertEqual([email.to[0] for email in mail.outbox], [emails[2].to])
+
+    @override_settings(EMAIL_BACKEND='evap.evaluation.tests.FailingEmailBackend', EMAIL_OUTBOX_MAX_ATTEMPTS=2, EMAIL_OUTBOX_RETRY_DELAY=60)
+    def test_failed_emails_are_tried_again_later(self):
+        self.assertEqual(send_outgoing_emails(), (0, 3))
+        # the next attempt is delayed
+        self.assertEqual(send_outgoing_emails(), (0, 0))
+
+        email = OutgoingEmail.objects.first()
+        self.assertEqual(email.attempts, 1)
+        self.assertIn("The mail server is unavailable", email.last_error)
+        self.assertAlmostEqual(email.next_attempt_time, datetime.now() + timedelta(seconds=60), delta=timedelta(seconds=10))
+
+        OutgoingEmail.objects.update(next_attempt_time=datetime.now())
+        self.assertEqual(send_outgoing_emails(), (0, 3))
+        email.refresh_from_db()
+        self.assertAlmostEqual(email.next_attempt_time, datetime.now() + timedelta(seconds=120), delta=timedelta(seconds=10))
+
+        self.assertTrue(email.is_failed)
+        self.assertEqual(OutgoingEmail.failed().count(), 3)
+        self.assertFalse(OutgoingEmail.pending().exists())
+
+    @override_settings(EMAIL_BACKEND='evap.evaluation.tests.UnreachableEmailBackend')
+    def test_all_emails_fail_if_the_connection_fails(self):
+        self.assertEqual(send_outgoing_emails(), (0, 3))
+        self.assertFalse(OutgoingEmail.objects.filter(attempts=0).exists())
+
+
+def make_published_course(num_participants, name="course"):
+    """Makes a published course with voting participants and a responsible contributor with a
+    delegate and a CC user. Returns the course and the contributor, name makes the emails unique."""
+    participants = mommy.make(UserProfile, email=iter(["{}.participant{}@example.com".format(name, i) for i in range(num_participants)]), _quantity=num_participants)
+    course = mommy.make(Course, state='published', vote_start_date=date(2016, 1, 1), vote_end_date=date(2016, 2, 1),
+                        participants=participants, voters=participants)
+    delegate, cc_user = mommy.make(UserProfile, email=iter([name + ".delegate@example.com", name + ".cc@example.com"]), _quantity=2)
+    contributor = mommy.make(UserProfile, email=name + ".contributor@example.com", delegates=[delegate], cc_users=[cc_user])
+    mommy.make(Contribution, course=course, contributor=contributor, responsible=True)
+    return course, contributor
+
+
+class PublishNotificationTests(TestCase):
+    def test_recipients_are_resolved_with_a_fixed_number_of_queries(self):
+        small_course, __ = make_published_course(2, name="small")
+        large_course, __ = make_published_course(20, name="large")
+
+        for course in (small_course, large_course):
+            with self.assertNumQueries(3):
+                recipients = get_publish_notification_recipients([course], [course])
+            self.assertEqual(len(recipients), course.num_participants + 1)
+            with self.assertNumQueries(2):
+                EmailTemplate.get_cc_addresses(recipients.keys())
+
+    def test_contributors_get_their_cc_addresses(self):
+        course, contributor = make_published_course(2)
+        send_publish_notifications(evaluation_results_courses=[course])
+        self.assertEqual(OutgoingEmail.objects.count(), 3)
+        self.assertEqual(json.loads(OutgoingEmail.objects.get(user=contributor).cc), ["course.cc@example.com", "course.delegate@example.com"])
+        self.assertEqual(json.loads(OutgoingEmail.objects.exclude(user=contributor).first().cc), [])
+
+
+class CourseEmailTests(TestCase):
+    def setUp(self):
+        self.delegate = mommy.make(UserProfile)
+        self.responsible = mommy.make(UserProfile, delegates=[self.delegate])
+        self.editor = mommy.make(UserProfile)
+        self.participants = mommy.make(UserProfile, _quantity=3)
+        self.courses = mommy.make(Course, participants=self.participants, voters=self.participants[:1], _quantity=2)
+        for course in self.courses:
+            mommy.make(Contribution, course=course, contributor=self.responsible, responsible=True, can_edit=True)
+            mommy.make(Contribution, course=course, contributor=self.delegate, can_edit=True)
+        mommy.make(Contribution, course=self.courses[1], contributor=self.editor, can_edit=True)
+
+    def test_recipients_for_courses(self):
+        with self.assertNumQueries(5):
+            recipients = EmailTemplate.recipients_for_courses(self.courses, ['responsible', 'editors', 'due_participants'])
+        expected = {participant: self.courses for participant in self.participants[1:]}
+        expected.update({self.responsible: self.courses, self.editor: [self.courses[1]]})
+        # the delegate gets the responsible's emails in cc
+        self.assertEqual(dict(recipients), expected)
+
+    def test_number_of_queries_does_not_depend_on_the_number_of_courses(self):
+        self.courses += mommy.make(Course, participants=self.participants, _quantity=5)
+        with self.assertNumQueries(4):
+            recipients = EmailTemplate.recipients_for_courses(self.courses, ['all_participants'])
+        self.assertEqual(recipients[self.participants[0]], self.courses)
+
+
+class ReminderTests(TestCase):
+    def test_due_reminders(self):
+        today = date.today()
+        users = mommy.make(UserProfile, _quantity=3)
+        ending_course = mommy.make(Course, state='inEvaluation', vote_end_date=today + timedelta(days=2), participants=users, voters=users[:1])
+        later_course = mommy.make(Course, state='inEvaluation', vote_end_date=today + timedelta(days=5), participants=users[1:])
+        mommy.make(Course, state='inEvaluation', vote_end_date=today + timedelta(days=1), participants=users[2:], voters=users[2:])
+        mommy.make(Course, state='evaluated', vote_end_date=today + timedelta(days=2), participants=users)
+
+        with self.assertNumQueries(3):
+            reminders = get_due_reminders([today + timedelta(days=2)])
+
+        self.assertEqual(reminders, [(user, 2, [(ending_course, 2), (later_course, 5)]) for user in users[1:]])
+        self.assertEqual(get_due_reminders([today + timedelta(days=1)]), [])
+
+
+class DatabaseCacheTests(TestCase):
+    def test_several_keys_at_once(self):
+        cache.set('existing', 1)
+        with self.assertNumQueries(1):
+            self.assertEqual(cache.get_many(['existing', 'missing']), {'existing': 1})
+
+        self.assertEqual(sorted(cache.add_many({'existing': 2, 'new': 2})), ['new'])
+        cache.set_many({'existing': 3, 'other': 3})
+        self.assertEqual(cache.get_many(['existing', 'new', 'other']), {'existing': 3, 'new': 2, 'other': 3})
+
+        cache.delete_many(['existing', 'new'])
+        self.assertEqual(cache.get_many(['existing', 'new', 'other']), {'other': 3})
+
+    def test_expired_keys_are_missing(self):
+        cache.set_many({'expired': 1}, timeout=-1)
+        self.assertEqual(cache.get_many(['expired']), {})
+        self.assertEqual(cache.add_many({'expired': 2}), ['expired'])
+        self.assertEqual(cache.get('expired'), 2)
+
+
+class RatingStatisticsTests(TestCase):
+
+    @staticmethod
+    def expand(counts):
+        return [answer for answer, count in counts.items() for i in range(count)]
+
+    def test_equivalence_to_expanded_answers(self):
+        """ Compares the histogram based statistics with the statistics of the expanded answer lists. """
+        randomizer = random.Random(42)
+        for i in range(200):
+            counts = empty_histogram()
+            for answer in counts:
+                counts[answer] = randomizer.choice([0, 0, 1, 2, 17, randomizer.randint(0, 600)])
+            answers = self.expand(counts)
+
+            total_count, average, deviation = calculate_rating_statistics(counts)
+
+            self.assertEqual(total_count, len(answers))
+            if not answers:
+                self.assertIsNone(average)
+                self.assertIsNone(deviation)
+                continue
+            expected_average = avg(answers)
+            self.assertAlmostEqual(average, expected_average, places=10)
+            self.assertAlmostEqual(deviation, pstdev(answers, expected_average), places=10)
+
+    def test_warning_threshold(self):
+        with self.settings(RESULTS_WARNING_PERCENTAGE=0.5):
+            self.assertEqual(warning_threshold([10, 2, 30]), 0.5 * median([10, 2, 30]))
+            self.assertEqual(warning_threshold([4, 8]), 3)
+
+
+class ParticipationTests(TestCase):
+    def test_participation_checks(self):
+        participant, voter, other_user = mommy.make(UserProfile, _quantity=3)
+        course = mommy.make(Course, state='inEvaluation', participants=[participant, voter] + mommy.make(UserProfile, _quantity=20),
+                            voters=[voter], vote_start_date=date.today(), vote_end_date=date.today())
+
+        self.assertTrue(course.is_participant(participant))
+        self.assertFalse(course.is_participant(other_user))
+        self.assertTrue(course.has_voted(voter))
+        self.assertFalse(course.has_voted(participant))
+
+        # one query each for participants and voters, regardless of their number
+        with self.assertNumQueries(2):
+            self.assertTrue(course.can_user_vote(participant))
+        self.assertFalse(course.can_user_vote(voter))
+        self.assertFalse(course.can_user_vote(other_user))
+
+    def test_participation_counts_are_kept_up_to_date(self):
+        users = mommy.make(UserProfile, _quantity=4)
+        course = mommy.make(Course, participants=users[:2])
+        self.assertEqual((course.num_participants, course.num_voters), (2, 0))
+
+        course.participants.add(*users)
+        course.voters.add(users[0])
+        course.participants.remove(users[1], users[1])
+        users[2].course_set.remove(course)
+        course = Course.objects.get(pk=course.pk)
+        self.assertEqual((course.num_participants, course.num_voters), (2, 1))
+
+        users[3].delete()
+        course.voters.clear()
+        course = Course.objects.get(pk=course.pk)
+        self.assertEqual((course.num_participants, course.num_voters), (1, 0))
+
+    def test_participation_counts_of_archived_courses_do_not_change(self):
+        users = mommy.make(UserProfile, _quantity=2)
+        course = mommy.make(Course, state='published', participants=users, voters=users)
+        course._archive()
+
+        users[0].delete()
+        course.participants.remove(users[1])
+        course = Course.objects.get(pk=course.pk)
+        self.assertEqual((course.num_participants, course.num_voters), (2, 2))
+
+    def test_participation_counts_of_loaded_fixtures_are_not_added_twice(self):
+        call_command("loaddata", "minimal_test_data", verbosity=0)
+        for course in Course.objects.all():
+            self.assertEqual((course.num_participants, course.num_voters), (course.participants.count(), course.voters.count()))
@@ -1,14 +1,23 @@
 from django.conf import settings
 from django.core.cache import cache
+from django.core.mail import get_connection
 from django.utils.translation import ugettext_lazy as _
-from django.db.models import Sum
-from evap.evaluation.models import TextAnswer, EmailTemplate, Course, Contribution, RatingAnswerCounter
+from django.db import transaction
+from django.db.models import F, Sum
+from evap.evaluation.models import TextAnswer, EmailTemplate, Course, Contribution, RatingAnswerCounter, CourseResultSummary, \
+                                   Questionnaire, Question, RatingAnswerAggregate, LoggedBallot, OutgoingEmail
+from evap.evaluation.rating_statistics import RATING_ANSWERS, empty_histogram, warning_threshold
 
-from collections import OrderedDict, defaultdict
+from collections import Counter, OrderedDict, defaultdict
 from collections import namedtuple
-from functools import partial
-from math import ceil, sqrt
-from statistics import pstdev, median
+from math import ceil
+import json
+import time
+from uuid import uuid4
+import datetime
+import logging
+
+logger = logging.getLogger(__name__)
 
 GRADE_COLORS = {
     1: (136, 191, 74),
@@ -74,6 +83,8 @@ CommentSection = namedtuple('CommentSection', ('questionnaire', 'contributor', '
 RatingResult = namedtuple('RatingResult', ('question', 'total_count', 'average', 'deviation', 'counts', 'warning'))
 TextResult = namedtuple('TextResult', ('question', 'answers'))
 
+CourseResults = namedtuple('CourseResults', ('sections', 'average_grade', 'deviation'))
+
 CourseLists = namedtuple('CourseLists', ('grade_document_courses', 'evaluation_results_courses'))
 
 def avg(iterable):
@@ -100,26 +111,10 @@ def get_answers(contribution, question):
     return question.answer_class.objects.filter(contribution=contribution, question=question)
 
 
-def get_number_of_answers(contribution, question):
-    answers = get_answers(contribution, question)
-    if question.is_rating_question:
-        return get_sum_of_answer_counters(answers)
-    else:
-        return len(answers)
-
-
 def get_sum_of_answer_counters(answer_counters):
     return answer_counters.aggregate(total_count=Sum('count'))['total_count'] or 0
 
 
-def get_answers_from_answer_counters(answer_counters):
-    answers = []
-    for answer_counter in answer_counters:
-        for i in range(0, answer_counter.count):
-            answers.append(answer_counter.answer)
-    return answers
-
-
 def get_textanswers(contribution, question, filter_states=None):
     assert question.is_text_question
     answers = get_answers(contribution, question)
@@ -128,76 +123,431 @@ def get_textanswers(contribution, question, filter_states=None):
     return answers
 
 
-def get_counts(answer_counters):
-    counts = OrderedDict()
-    # ensure ordering of answers
-    for answer in range(1,6):
-        counts[answer] = 0
+def add_answers(rating_answers, text_answers):
+    """Saves the given answers in a constant number of queries. `rating_answers`
+    are (contribution id, question id, answer) tuples, they are added to the
+    `RatingAnswerCounter`s and `RatingAnswerAggregate`s. `text_answers` are
+    (contribution id, question id, answer) tuples, each creates a `TextAnswer`.
+
+    No signals are sent for the answers. That's fine while courses are in
+    evaluation, as their results are neither cached nor summarized."""
+    counter_increments = Counter(rating_answers)
+    aggregate_increments = defaultdict(lambda: [0, 0, 0])
+    for (contribution_id, question_id, answer), count in counter_increments.items():
+        aggregate_increment = aggregate_increments[(contribution_id, question_id)]
+        aggregate_increment[0] += count
+        aggregate_increment[1] += count * answer
+        aggregate_increment[2] += count * answer ** 2
+
+    contribution_ids = {contribution_id for contribution_id, question_id in aggregate_increments}
+    question_ids = {question_id for contribution_id, question_id in aggregate_increments}
+
+    # rows with the same increment are updated together
+    existing_counters = RatingAnswerCounter.objects.filter(contribution_id__in=contribution_ids, question_id__in=question_ids)
+    counter_ids = {(contribution_id, question_id, answer): counter_id
+                   for counter_id, contribution_id, question_id, answer in existing_counters.values_list('id', 'contribution_id', 'question_id', 'answer')}
+    counter_ids_by_increment = defaultdict(list)
+    for key, count in counter_increments.items():
+        if key in counter_ids:
+            counter_ids_by_increment[count].append(counter_ids[key])
+    for count, ids in counter_ids_by_increment.items():
+        RatingAnswerCounter.objects.filter(id__in=ids).update(count=F('count') + count)
+    RatingAnswerCounter.objects.bulk_create(
+        RatingAnswerCounter(contribution_id=contribution_id, question_id=question_id, answer=answer, count=count)
+        for (contribution_id, question_id, answer), count in counter_increments.items() if (contribution_id, question_id, answer) not in counter_ids
+    )
 
-    for answer_counter in answer_counters:
-        counts[answer_counter.answer] = answer_counter.count
-    return counts
+    existing_aggregates = RatingAnswerAggregate.objects.filter(contribution_id__in=contribution_ids, question_id__in=question_ids)
+    aggregate_ids = {(contribution_id, question_id): aggregate_id
+                     for aggregate_id, contribution_id, question_id in existing_aggregates.values_list('id', 'contribution_id', 'question_id')}
+    aggregate_ids_by_increment = defaultdict(list)
+    for key, increment in aggregate_increments.items():
+        if key in aggregate_ids:
+            aggregate_ids_by_increment[tuple(increment)].append(aggregate_ids[key])
+    for (count, answer_sum, sum_of_squares), ids in aggregate_ids_by_increment.items():
+        RatingAnswerAggregate.objects.filter(id__in=ids).update(
+            count=F('count') + count, sum=F('sum') + answer_sum, sum_of_squares=F('sum_of_squares') + sum_of_squares)
+    RatingAnswerAggregate.objects.bulk_create(
+        RatingAnswerAggregate(contribution_id=contribution_id, question_id=question_id, count=count, sum=answer_sum, sum_of_squares=sum_of_squares)
+        for (contribution_id, question_id), (count, answer_sum, sum_of_squares) in aggregate_increments.items() if (contribution_id, question_id) not in aggregate_ids
+    )
 
+    TextAnswer.objects.bulk_create(
+        TextAnswer(contribution_id=contribution_id, question_id=question_id, answer=answer)
+        for contribution_id, question_id, answer in text_answers
+    )
 
-def calculate_results(course):
-    if course.state != "published":
-        return _calculate_results_impl(course)
 
-    cache_key = str.format('evap.staff.results.tools.calculate_results-{:d}', course.id)
-    return cache.get_or_set(cache_key, partial(_calculate_results_impl, course), None)
+def log_ballot(course, rating_answers, text_answers):
+    """Stores the answers of a vote in the ballot log instead of adding them,
+    see settings.DEFERRED_VOTE_AGGREGATION and `add_answers`."""
+    LoggedBallot.objects.create(course=course, answers=json.dumps(dict(rating_answers=rating_answers, text_answers=text_answers)))
+
+
+def process_ballot_log(batch_size=1000):
+    """Adds the answers of all logged ballots with `add_answers`, processing
+    `batch_size` ballots per transaction. Returns the number of ballots."""
+    count = 0
+    while True:
+        with transaction.atomic():
+            # the ballots are processed in no particular order, see LoggedBallot
+            ballots = list(LoggedBallot.objects.select_for_update()[:batch_size])
+            if not ballots:
+                return count
+
+            rating_answers = []
+            text_answers = []
+            for ballot in ballots:
+                answers = json.loads(ballot.answers)
+                rating_answers.extend(tuple(rating_answer) for rating_answer in answers['rating_answers'])
+                text_answers.extend(answers['text_answers'])
+            add_answers(rating_answers, text_answers)
+
+            LoggedBallot.objects.filter(id__in=[ballot.id for ballot in ballots]).delete()
+        count += len(ballots)
+
+
+def rebuild_rating_answer_aggregates(contributions):
+    """Recalculates the `RatingAnswerAggregate`s of the given contributions
+    (a queryset) from their `RatingAnswerCounter`s."""
+    aggregates = {}
+    for answer_counter in RatingAnswerCounter.objects.filter(contribution__in=contributions):
+        key = (answer_counter.contribution_id, answer_counter.question_id)
+        aggregate = aggregates.setdefault(key, RatingAnswerAggregate(contribution_id=key[0], question_id=key[1]))
+        aggregate.count += answer_counter.count
+        aggregate.sum += answer_counter.count * answer_counter.answer
+        aggregate.sum_of_squares += answer_counter.count * answer_counter.answer ** 2
+
+    with transaction.atomic():
+        RatingAnswerAggregate.objects.filter(contribution__in=contributions).delete()
+        RatingAnswerAggregate.objects.bulk_create(aggregates.values())
+
+
+# results of courses in these states are cached, earlier on they still change with every vote
+RESULTS_CACHE_STATES = ('evaluated', 'reviewed', 'published')
+
+# cached results and their versions are removed after this many seconds, also those that became outdated
+RESULTS_CACHE_TIMEOUT = 7 * 24 * 60 * 60
+
+# while results are calculated, others wait for them, see _get_compact_sections. all values in seconds
+RESULTS_LOCK_TIMEOUT = 60
+RESULTS_LOCK_WAIT = 10
+RESULTS_LOCK_POLL_INTERVAL = 0.1
+
+
+def _add_many_to_cache(data, timeout):
+    """Adds the keys that are not in the cache yet and returns them, see
+    evaluation.cache.DatabaseCache.add_many. Other cache backends add one key
+    after the other."""
+    if hasattr(cache, 'add_many'):
+        return cache.add_many(data, timeout)
+    return [key for key, value in data.items() if cache.add(key, value, timeout)]
+
+
+def get_results_cache_version_key(course_id):
+    return str.format('evap.evaluation.tools.results_version-{:d}', course_id)
+
+
+def get_results_cache_key(course_id, version):
+    # the name changes together with the format of the compact results, see _calculate_compact_sections
+    return str.format('evap.evaluation.tools.compact_results-{:d}-{}', course_id, version)
+
+
+def get_results_cache_keys(courses):
+    """Returns a dict mapping each of the given courses whose results are
+    cached to its current cache key. The key contains a version that is
+    replaced by `invalidate_results` whenever the results of the course change.
+    The versions of all courses are read and written with a constant number
+    of cache accesses.
+
+    Missing versions are added, not set, so that concurrent requests agree on
+    one key and its lock, see _get_compact_sections."""
+    courses = [course for course in courses if course.state in RESULTS_CACHE_STATES]
+    version_keys = {course: get_results_cache_version_key(course.id) for course in courses}
+    versions = cache.get_many(version_keys.values())
 
+    new_versions = {version_keys[course]: uuid4().hex for course in courses if version_keys[course] not in versions}
+    if new_versions:
+        added_version_keys = set(_add_many_to_cache(new_versions, RESULTS_CACHE_TIMEOUT))
+        # the other versions were added by another request in the meantime
+        versions.update(cache.get_many([version_key for version_key in new_versions if version_key not in added_version_keys]))
+        for version_key, version in new_versions.items():
+            # also if the cache couldn't be written, the results are calculated without being cached then
+            versions.setdefault(version_key, version)
 
-def _calculate_results_impl(course):
+    return {course: get_results_cache_key(course.id, versions[version_keys[course]]) for course in courses}
+
+
+def get_results_lock_key(cache_key):
+    return cache_key + '-lock'
+
+
+def invalidate_results(course_ids):
+    """Makes sure the results of the given courses are calculated again the
+    next time they are requested. The outdated results are removed."""
+    version_keys = {get_results_cache_version_key(course_id): course_id for course_id in set(course_ids)}
+    old_versions = cache.get_many(version_keys.keys())
+    cache.delete_many([get_results_cache_key(version_keys[version_key], version) for version_key, version in old_versions.items()])
+    cache.set_many({version_key: uuid4().hex for version_key in version_keys}, RESULTS_CACHE_TIMEOUT)
+
+
+def calculate_results(course):
     """Calculates the result data for a single course. Returns a list of
     `ResultSection` tuples. Each of those tuples contains the questionnaire, the
     contributor (or None), a list of single result elements, the average grade and
     deviation for that section (or None). The result elements are either
-    `RatingResult` or `TextResult` instances."""
+    `RatingResult` or `TextResult` instances, the answers of the latter are
+    `TextAnswerResult` instances."""
+    return calculate_results_for_courses([course])[course].sections
+
+
+def calculate_results_for_semester(semester, states=('published',)):
+    """Calculates the results of all courses of the semester that are in one
+    of the given states. See `calculate_results_for_courses`."""
+    return calculate_results_for_courses(semester.course_set.filter(state__in=states))
+
+
+def calculate_results_for_courses(courses, metadata=None):
+    """Calculates the results of several courses at once. Returns an
+    `OrderedDict` mapping each course to a `CourseResults` tuple containing the
+    result sections (see `calculate_results`) and the final average grade and
+    deviation (see `calculate_average_grades_and_deviation`).
+
+    Cached results are used where available, all missing results are
+    calculated together in a constant number of queries. The cache only holds
+    ids, numbers and texts (see `_calculate_compact_sections`), the referenced
+    objects are looked up with the given `ResultMetadata`. Pass the same
+    instance to several calls to load every object only once."""
+    courses = list(courses)
+    if metadata is None:
+        metadata = ResultMetadata()
+
+    compact_sections = _get_compact_sections(courses, metadata)
+    metadata.load(compact_sections)
+
+    results = OrderedDict()
+    for course, course_compact_sections in compact_sections.items():
+        sections = metadata.rehydrate(course_compact_sections)
+        results[course] = CourseResults(sections, *average_grade_and_deviation(sections))
+    return results
+
+
+def _get_compact_sections(courses, metadata):
+    """Returns an `OrderedDict` mapping the courses to their compact sections,
+    which are taken from the cache or calculated.
+
+    Only one process calculates missing results at a time: it holds a lock in
+    the cache while the others poll the cache for the result. If the result
+    doesn't show up within RESULTS_LOCK_WAIT seconds, they calculate it
+    themselves. If the lock can't be written, the result is calculated right
+    away."""
+    cache_keys = get_results_cache_keys(courses)
+    compact_sections = cache.get_many(cache_keys.values())
+
+    missing_courses = [course for course in courses if cache_keys.get(course) not in compact_sections]
+    lock_keys = {get_results_lock_key(cache_keys[course]): course for course in missing_courses if course in cache_keys}
+    acquired_lock_keys = set(_add_many_to_cache(dict.fromkeys(lock_keys, True), RESULTS_LOCK_TIMEOUT))
+    # a lock that wasn't acquired is held by another process, unless writing it failed (e.g. because the database is locked)
+    held_lock_keys = cache.get_many([lock_key for lock_key in lock_keys if lock_key not in acquired_lock_keys]).keys()
+    waiting_courses = [lock_keys[lock_key] for lock_key in held_lock_keys]
+    locked_courses = [course for course in missing_courses if course not in waiting_courses]
+
+    calculated_sections = {}
+    try:
+        calculated_sections.update(_calculate_results_for_courses(locked_courses, metadata))
+        cache.set_many({cache_keys[course]: calculated_sections[course.id] for course in locked_courses if course in cache_keys}, RESULTS_CACHE_TIMEOUT)
+    finally:
+        cache.delete_many(acquired_lock_keys)
+
+    for __ in range(int(RESULTS_LOCK_WAIT / RESULTS_LOCK_POLL_INTERVAL)):
+        if not waiting_courses:
+            break
+        time.sleep(RESULTS_LOCK_POLL_INTERVAL)
+        compact_sections.update(cache.get_many([cache_keys[course] for course in waiting_courses]))
+        waiting_courses = [course for course in waiting_courses if cache_keys[course] not in compact_sections]
+    # the process holding the lock takes too long or died, don't wait any longer
+    calculated_sections.update(_calculate_results_for_courses(waiting_courses, metadata))
+    cache.set_many({cache_keys[course]: calculated_sections[course.id] for course in waiting_courses}, RESULTS_CACHE_TIMEOUT)
+
+    return OrderedDict(
+        (course, calculated_sections[course.id] if course.id in calculated_sections else compact_sections[cache_keys[course]])
+        for course in courses
+    )
 
-    # there will be one section per relevant questionnaire--contributor pair
+
+class TextAnswerResult:
+    """A text answer as contained in the results. It only holds what is needed
+    to show the answer and to decide who may see it."""
+    __slots__ = ('id', 'answer', 'state', 'contribution')
+
+    def __init__(self, id, answer, state, contribution):
+        self.id = id
+        self.answer = answer
+        self.state = state
+        self.contribution = contribution
+
+    @property
+    def is_private(self):
+        return self.state == TextAnswer.PRIVATE
+
+    @property
+    def is_published(self):
+        return self.state == TextAnswer.PUBLISHED
+
+    def __eq__(self, other):
+        return isinstance(other, TextAnswerResult) and self.id == other.id
+
+    def __hash__(self):
+        return hash(self.id)
+
+
+class ResultMetadata(object):
+    """Holds the questionnaires, questions and contributions referenced by the
+    compact results of courses and turns those into result sections. Objects
+    that are not known yet are loaded in bulk, every object is loaded once."""
+
+    def __init__(self):
+        self.questionnaires = {}
+        self.questions = {}
+        self.contributions = {}
+
+    def add(self, course_questionnaires_and_contributions):
+        for questionnaire, contribution in course_questionnaires_and_contributions:
+            self.questionnaires[questionnaire.id] = questionnaire
+            self.questions.update((question.id, question) for question in questionnaire.question_set.all())
+            self.contributions[contribution.id] = contribution
+
+    def load(self, compact_sections_by_course):
+        """Loads all objects referenced by the given compact sections, which
+        is a dict mapping courses to their compact sections."""
+        questionnaire_ids, question_ids, contribution_ids = set(), set(), set()
+        for course_compact_sections in compact_sections_by_course.values():
+            for questionnaire_id, contribution_id, results, warning in course_compact_sections:
+                questionnaire_ids.add(questionnaire_id)
+                contribution_ids.add(contribution_id)
+                question_ids.update(result[0] for result in results)
+
+        questionnaire_ids.difference_update(self.questionnaires)
+        if questionnaire_ids:
+            self.questionnaires.update(Questionnaire.objects.in_bulk(questionnaire_ids))
+        question_ids.difference_update(self.questions)
+        if question_ids:
+            self.questions.update(Question.objects.in_bulk(question_ids))
+        contribution_ids.difference_update(self.contributions)
+        if contribution_ids:
+            courses_by_id = {course.id: course for course in compact_sections_by_course}
+            contributions = Contribution.objects.filter(id__in=contribution_ids).select_related('contributor')
+            for contribution in contributions:
+                contribution.course = courses_by_id[contribution.course_id]
+                self.contributions[contribution.id] = contribution
+
+    def rehydrate(self, compact_sections):
+        """Turns compact sections into `ResultSection` tuples. All referenced
+        objects must have been loaded before."""
+        sections = []
+        for questionnaire_id, contribution_id, compact_results, section_warning in compact_sections:
+            contribution = self.contributions[contribution_id]
+            results = []
+            for compact_result in compact_results:
+                question = self.questions[compact_result[0]]
+                if question.is_rating_question:
+                    question_id, counts, statistics, warning = compact_result
+                    counts = OrderedDict(zip(RATING_ANSWERS, counts))
+                    results.append(RatingResult(question, *statistics, counts=counts, warning=warning))
+                else:
+                    question_id, answers = compact_result
+                    answers = [TextAnswerResult(answer_id, answer, state, contribution) for answer_id, answer, state in answers]
+                    results.append(TextResult(question=question, answers=answers))
+            sections.append(ResultSection(self.questionnaires[questionnaire_id], contribution.contributor, contribution.label, results, section_warning))
+        return sections
+
+
+def _calculate_results_for_courses(courses, metadata):
+    """Calculates the compact result sections of all given courses, see
+    `_calculate_compact_sections`. Returns a dict mapping course ids to them.
+    The loaded questionnaires, questions and contributions are added to the
+    metadata.
+
+    All answers of the courses are loaded up front, so the number of queries
+    does not depend on the number of courses, contributions and questions."""
+    if not courses:
+        return {}
+
+    questionnaires_and_contributions_by_course = _questionnaires_and_contributions_by_course(courses)
+    for course_questionnaires_and_contributions in questionnaires_and_contributions_by_course.values():
+        metadata.add(course_questionnaires_and_contributions)
+
+    # index all answers by (contribution id, question id)
+    answer_counts = defaultdict(empty_histogram)
+    for answer_counter in RatingAnswerCounter.objects.filter(contribution__course__in=courses):
+        answer_counts[(answer_counter.contribution_id, answer_counter.question_id)][answer_counter.answer] = answer_counter.count
+
+    aggregates = defaultdict(RatingAnswerAggregate)
+    for aggregate in RatingAnswerAggregate.objects.filter(contribution__course__in=courses):
+        aggregates[(aggregate.contribution_id, aggregate.question_id)] = aggregate
+
+    textanswers = defaultdict(list)
+    textanswer_values = TextAnswer.objects.filter(contribution__course__in=courses, state__in=[TextAnswer.PRIVATE, TextAnswer.PUBLISHED]) \
+        .values_list('id', 'contribution_id', 'question_id', 'reviewed_answer', 'original_answer', 'state')
+    for textanswer_id, contribution_id, question_id, reviewed_answer, original_answer, state in textanswer_values:
+        # see TextAnswer.answer
+        textanswers[(contribution_id, question_id)].append((textanswer_id, reviewed_answer or original_answer, state))
+
+    return {course.id: _calculate_compact_sections(questionnaires_and_contributions_by_course[course.id], answer_counts, aggregates, textanswers)
+            for course in courses}
+
+
+def _calculate_compact_sections(course_questionnaires_and_contributions, answer_counts, aggregates, textanswers):
+    """Returns the sections of a course in the compact form that is cached.
+    That's a list of (questionnaire id, contribution id, results, warning)
+    tuples, where each result is a (question id, counts, statistics, warning)
+    tuple for rating questions and a (question id, answers) tuple for text
+    questions. The statistics are the total count, average and deviation
+    taken from the `RatingAnswerAggregate`, the counts are only shown. The
+    answers are (text answer id, answer, state) tuples."""
+    # there will be one section per relevant questionnaire--contribution pair
     sections = []
 
     # calculate the median values of how many people answered a questionnaire type (lecturer, tutor, ...)
     questionnaire_med_answers = defaultdict(list)
     questionnaire_max_answers = {}
     questionnaire_warning_thresholds = {}
-    for questionnaire, contribution in questionnaires_and_contributions(course):
-        max_answers = max([get_number_of_answers(contribution, question) for question in questionnaire.rating_questions], default=0)
+    for questionnaire, contribution in course_questionnaires_and_contributions:
+        max_answers = max([aggregates[(contribution.id, question.id)].total_count for question in questionnaire.rating_questions], default=0)
         questionnaire_max_answers[(questionnaire, contribution)] = max_answers
         questionnaire_med_answers[questionnaire].append(max_answers)
     for questionnaire, max_answers in questionnaire_med_answers.items():
-        questionnaire_warning_thresholds[questionnaire] = settings.RESULTS_WARNING_PERCENTAGE * median(max_answers)
+        questionnaire_warning_thresholds[questionnaire] = warning_threshold(max_answers)
 
-    for questionnaire, contribution in questionnaires_and_contributions(course):
-        # will contain one object per question
+    for questionnaire, contribution in course_questionnaires_and_contributions:
+        # will contain one tuple per question
         results = []
         for question in questionnaire.question_set.all():
             if question.is_rating_question:
-                answer_counters = get_answers(contribution, question)
-                answers = get_answers_from_answer_counters(answer_counters)
-
-                total_count = len(answers)
-                average = avg(answers) if total_count > 0 else None
-                deviation = pstdev(answers, average) if total_count > 0 else None
-                counts = get_counts(answer_counters)
-                warning = total_count > 0 and total_count < questionnaire_warning_thresholds[questionnaire]
-
-                results.append(RatingResult(question, total_count, average, deviation, counts, warning))
+                aggregate = aggregates[(contribution.id, question.id)]
+                count = aggregate.total_count
+                warning = count > 0 and count < questionnaire_warning_thresholds[questionnaire]
+                statistics = (count, aggregate.average, aggregate.deviation)
+                results.append((question.id, tuple(answer_counts[(contribution.id, question.id)].values()), statistics, warning))
 
             elif question.is_text_question:
-                allowed_states = [TextAnswer.PRIVATE, TextAnswer.PUBLISHED]
-                answers = get_textanswers(contribution, question, allowed_states)
-                results.append(TextResult(question=question, answers=answers))
+                results.append((question.id, tuple(textanswers[(contribution.id, question.id)])))
 
         section_warning = questionnaire_max_answers[(questionnaire, contribution)] < questionnaire_warning_thresholds[questionnaire]
 
-        sections.append(ResultSection(questionnaire, contribution.contributor, contribution.label, results, section_warning))
+        sections.append((questionnaire.id, contribution.id, results, section_warning))
 
     return sections
 
 
 def calculate_average_grades_and_deviation(course):
     """Determines the final average grade and deviation for a course."""
+    return average_grade_and_deviation(calculate_results(course))
+
+
+def average_grade_and_deviation(sections):
+    """Determines the final average grade and deviation from the result
+    sections of a course."""
     avg_generic_likert = []
     avg_contribution_likert = []
     dev_generic_likert = []
@@ -207,7 +557,7 @@ def calculate_average_grades_and_deviation(course):
     dev_generic_grade = []
     dev_contribution_grade = []
 
-    for questionnaire, contributor, label, results, warning in calculate_results(course):
+    for questionnaire, contributor, label, results, warning in sections:
         average_likert = avg([result.average for result in results if result.question.is_likert_question])
         deviation_likert = avg([result.deviation for result in results if result.question.is_likert_question])
         average_grade = avg([result.average for result in results if result.question.is_grade_question])
@@ -234,16 +584,68 @@ def calculate_average_grades_and_deviation(course):
     return final_avg, final_dev
 
 
+def update_result_summary(course):
+    """Recalculates and stores the `CourseResultSummary` of the course.
+    This is done automatically whenever the results of a course change, see the
+    signal receivers next to `CourseResultSummary`."""
+    course_results = calculate_results_for_courses([course])[course]
+    average_grade, deviation = course_results.average_grade, course_results.deviation
+    summary, created = CourseResultSummary.objects.update_or_create(course=course, defaults=dict(
+        average_grade=average_grade,
+        deviation=deviation,
+        num_voters=course.num_voters,
+        num_participants=course.num_participants,
+    ))
+    course.result_summary = summary
+    return summary
+
+
+def update_result_summaries(course_ids):
+    """Recalculates the existing `CourseResultSummary`s of the given courses
+    at once, e.g. after their questionnaires changed. Courses without a
+    summary get one when it is needed, see `get_result_summary`."""
+    courses = [summary.course for summary in CourseResultSummary.objects.filter(course_id__in=course_ids).select_related('course')]
+    for course, course_results in calculate_results_for_courses(courses).items():
+        # updating doesn't create summaries again, e.g. while the course is being deleted
+        CourseResultSummary.objects.filter(course=course).update(average_grade=course_results.average_grade, deviation=course_results.deviation)
+
+
+def get_result_summary(course):
+    """Returns the `CourseResultSummary` of the course, which must be in one
+    of `CourseResultSummary.COURSE_STATES`. Use select_related('result_summary')
+    when getting summaries for many courses."""
+    try:
+        return course.result_summary
+    except CourseResultSummary.DoesNotExist:
+        # e.g. courses that were evaluated before summaries existed
+        return update_result_summary(course)
+
+
+def has_no_rating_answers(results):
+    """Returns whether nobody answered any of the rating questions of a result section."""
+    return not any(result.total_count > 0 for result in results if result.question.is_rating_question)
+
+
 def questionnaires_and_contributions(course):
     """Yields tuples of (questionnaire, contribution) for the given course."""
-    result = []
+    return _questionnaires_and_contributions_by_course([course])[course.id]
+
 
-    for contribution in course.contributions.all():
+def _questionnaires_and_contributions_by_course(courses):
+    """Returns a dict mapping the ids of the given courses to lists of
+    (questionnaire, contribution) tuples, see questionnaires_and_contributions."""
+    courses_by_id = {course.id: course for course in courses}
+    result = {course_id: [] for course_id in courses_by_id}
+
+    contributions = Contribution.objects.filter(course__in=courses).select_related('contributor').prefetch_related('questionnaires__question_set')
+    for contribution in contributions:
+        contribution.course = courses_by_id[contribution.course_id]
         for questionnaire in contribution.questionnaires.all():
-            result.append((questionnaire, contribution))
+            result[contribution.course_id].append((questionnaire, contribution))
 
     # sort questionnaires for general contributions first
-    result.sort(key=lambda t: not t[1].is_general)
+    for course_questionnaires_and_contributions in result.values():
+        course_questionnaires_and_contributions.sort(key=lambda t: not t[1].is_general)
 
     return result
 
@@ -252,38 +654,178 @@ def is_external_email(email):
     return not any([email.endswith("@" + domain) for domain in settings.INSTITUTION_EMAIL_DOMAINS])
 
 
-def send_publish_notifications(grade_document_courses=None, evaluation_results_courses=None):
-    grade_document_courses = grade_document_courses or []
-    evaluation_results_courses = evaluation_results_courses or []
+def warm_results_cache(courses):
+    """Makes sure the results and result summaries of the courses are
+    calculated, so the first visitors of their results don't have to wait."""
+    for course in calculate_results_for_courses(courses):
+        get_result_summary(course)
+
+
+def get_publish_notification_recipients(grade_document_courses, evaluation_results_courses):
+    """Returns a dict mapping each user who gets a publish notification to the CourseLists
+    of the user. The participants, contributors and comment owners of all courses are
+    loaded with a fixed number of queries, regardless of how many users there are."""
+    course_ids = {course.id for course in grade_document_courses} | {course.id for course in evaluation_results_courses}
+    users = {}
+
+    participants = defaultdict(list)
+    for participation in Course.participants.through.objects.filter(course_id__in=course_ids).select_related('userprofile'):
+        participants[participation.course_id].append(users.setdefault(participation.userprofile_id, participation.userprofile))
+
+    contributors = defaultdict(list)
+    responsible_contributors = {}
+    for contribution in Contribution.objects.filter(course_id__in=course_ids).exclude(contributor=None).select_related('contributor'):
+        contributor = users.setdefault(contribution.contributor_id, contribution.contributor)
+        contributors[contribution.course_id].append(contributor)
+        if contribution.responsible:
+            responsible_contributors[contribution.course_id] = contributor
+
+    # the contributors of all text answers, None for answers to the general questionnaires
+    commenter_ids = defaultdict(set)
+    for course_id, contributor_id in (TextAnswer.objects.filter(contribution__course_id__in=course_ids)
+            .values_list('contribution__course_id', 'contribution__contributor_id').distinct()):
+        commenter_ids[course_id].add(contributor_id)
 
     publish_notifications = defaultdict(lambda: CourseLists(set(), set()))
 
     for course in evaluation_results_courses:
         # for published courses all contributors and participants get a notification
         if course.can_publish_grades:
-            for participant in course.participants.all():
-                publish_notifications[participant].evaluation_results_courses.add(course)
-            for contribution in course.contributions.all():
-                if contribution.contributor:
-                    publish_notifications[contribution.contributor].evaluation_results_courses.add(course)
+            for user in participants[course.id] + contributors[course.id]:
+                publish_notifications[user].evaluation_results_courses.add(course)
         # if a course was not published notifications are only sent for contributors who can see comments
-        elif len(course.textanswer_set) > 0:
-            for textanswer in course.textanswer_set:
-                if textanswer.contribution.contributor:
-                    publish_notifications[textanswer.contribution.contributor].evaluation_results_courses.add(course)
-            publish_notifications[course.responsible_contributor].evaluation_results_courses.add(course)
+        elif commenter_ids[course.id]:
+            for contributor_id in commenter_ids[course.id] - {None}:
+                publish_notifications[users[contributor_id]].evaluation_results_courses.add(course)
+            if course.id in responsible_contributors:
+                publish_notifications[responsible_contributors[course.id]].evaluation_results_courses.add(course)
     for course in grade_document_courses:
         # all participants who can download grades get a notification
-        for participant in course.participants.all():
+        for participant in participants[course.id]:
             if participant.can_download_grades:
                 publish_notifications[participant].grade_document_courses.add(course)
 
-    for user, course_lists in publish_notifications.items():
-        EmailTemplate.send_publish_notifications_to_user(
-            user,
-            grade_document_courses=list(course_lists.grade_document_courses),
-            evaluation_results_courses=list(course_lists.evaluation_results_courses)
-        )
+    return publish_notifications
+
+
+def send_publish_notifications(grade_document_courses=None, evaluation_results_courses=None):
+    grade_document_courses = grade_document_courses or []
+    evaluation_results_courses = evaluation_results_courses or []
+
+    # the notifications make many people look at the results at once
+    warm_results_cache(evaluation_results_courses)
+
+    publish_notifications = get_publish_notification_recipients(grade_document_courses, evaluation_results_courses)
+    if not publish_notifications:
+        return
+
+    template = EmailTemplate.objects.get(name=EmailTemplate.PUBLISHING_NOTICE)
+    cc_addresses = EmailTemplate.get_cc_addresses(publish_notifications.keys())
+
+    with transaction.atomic():
+        for user, course_lists in publish_notifications.items():
+            EmailTemplate.send_publish_notifications_to_user(
+                user,
+                grade_document_courses=list(course_lists.grade_document_courses),
+                evaluation_results_courses=list(course_lists.evaluation_results_courses),
+                template=template,
+                cc_addresses=cc_addresses[user.id]
+            )
+
+
+def get_due_reminders(check_dates):
+    """Returns a list of (user, first_due_in_days, due_courses) tuples for all participants who
+    haven't voted for a course in evaluation that ends on one of the check dates. due_courses
+    contains (course, due_in_days) tuples of all courses the user still has to vote for, sorted by
+    the days left. Uses three queries, regardless of how many users there are."""
+    today = datetime.date.today()
+    courses = {course.id: course for course in Course.objects.filter(state='inEvaluation')}
+    votes = set(Course.voters.through.objects.filter(course__state='inEvaluation').values_list('course_id', 'userprofile_id'))
+
+    users = {}
+    due_courses = defaultdict(list)
+    for participation in Course.participants.through.objects.filter(course__state='inEvaluation').select_related('userprofile'):
+        course = courses.get(participation.course_id)
+        # skip courses whose state changed in between the queries
+        if course is None or (participation.course_id, participation.userprofile_id) in votes:
+            continue
+        users.setdefault(participation.userprofile_id, participation.userprofile)
+        due_courses[participation.userprofile_id].append((course, (course.vote_end_date - today).days))
+
+    reminders = []
+    for user_id, user_due_courses in sorted(due_courses.items()):
+        if any(course.vote_end_date in check_dates for course, __ in user_due_courses):
+            user_due_courses.sort(key=lambda due_course: due_course[1])
+            reminders.append((users[user_id], user_due_courses[0][1], user_due_courses))
+    return reminders
+
+
+def send_outgoing_emails(emails=None, batch_size=None):
+    """Sends the given emails or the next batch of due emails from the outbox
+    through a single connection, at most settings.EMAIL_OUTBOX_RATE_LIMIT per
+    second. Emails that can't be sent are tried again later. Returns the
+    numbers of sent and failed emails.
+
+    The emails are claimed first, so that runs of this function in other
+    processes skip them, see `_claim_outgoing_emails`."""
+    if emails is None:
+        emails = list(OutgoingEmail.pending().filter(next_attempt_time__lte=datetime.datetime.now())
+            .order_by('next_attempt_time', 'id')[:batch_size or settings.EMAIL_OUTBOX_BATCH_SIZE])
+    emails = _claim_outgoing_emails(emails)
+    if not emails:
+        return 0, 0
+
+    connection = get_connection()
+    try:
+        connection.open()
+    except Exception as e:
+        for email in emails:
+            _email_failed(email, e)
+        return 0, len(emails)
+
+    num_sent = 0
+    start = time.perf_counter()
+    try:
+        for index, email in enumerate(emails):
+            if settings.EMAIL_OUTBOX_RATE_LIMIT:
+                time.sleep(max(0, start + index / settings.EMAIL_OUTBOX_RATE_LIMIT - time.perf_counter()))
+            try:
+                email.message(connection).send()
+            except Exception as e:
+                _email_failed(email, e)
+                continue
+            email.sent_time = datetime.datetime.now()
+            email.last_error = ""
+            email.save()
+            num_sent += 1
+            logger.info('Sent email "{}" to {}.'.format(email.subject, email.to))
+    finally:
+        connection.close()
+
+    return num_sent, len(emails) - num_sent
+
+
+def _claim_outgoing_emails(emails):
+    """Returns the given emails that weren't claimed or sent by another process
+    since they were loaded, and claims them by moving their next attempt
+    EMAIL_OUTBOX_CLAIM_TIMEOUT seconds ahead. If the process dies before
+    sending them, they are sent after that time."""
+    claimed_until = datetime.datetime.now() + datetime.timedelta(seconds=settings.EMAIL_OUTBOX_CLAIM_TIMEOUT)
+    claimed_emails = []
+    for email in emails:
+        # only succeeds if nobody changed the email in the meantime
+        if OutgoingEmail.objects.filter(id=email.id, sent_time=None, next_attempt_time=email.next_attempt_time).update(next_attempt_time=claimed_until):
+            email.next_attempt_time = claimed_until
+            claimed_emails.append(email)
+    return claimed_emails
+
+
+def _email_failed(email, exception):
+    email.attempts += 1
+    email.last_error = "{}: {}".format(type(exception).__name__, exception)
+    email.next_attempt_time = datetime.datetime.now() + datetime.timedelta(seconds=settings.EMAIL_OUTBOX_RETRY_DELAY * 2 ** (email.attempts - 1))
+    email.save()
+    logger.exception('An exception occurred when sending the email "{}" to {} (attempt {}).'.format(email.subject, email.to, email.attempts))
 
 
 def color_mix(color1, color2, fraction):
@@ -317,8 +859,3 @@ def sort_formset(request, formset):
 
 def course_types_in_semester(semester):
     return Course.objects.filter(semester=semester).values_list('type', flat=True).order_by().distinct()
-
-def has_no_rating_answers(course, contributor, questionnaire):
-    questions = questionnaire.rating_questions
-    contribution = Contribution.objects.get(course=course, contributor=contributor)
-    return RatingAnswerCounter.objects.filter(question__in=questions, contribution=contribution).count() == 0
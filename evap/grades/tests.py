@@ -8,6 +8,7 @@ import tempfile
 import datetime
 
 from evap.evaluation.models import UserProfile, Course, Questionnaire, Contribution
+from evap.evaluation.tools import send_outgoing_emails
 
 
 class GradeUploadTests(WebTest):
@@ -85,6 +86,7 @@ class GradeUploadTests(WebTest):
         self.assertEqual(response.status_code, 200)
         self.assertIn("Successfully", response)
         self.assertEqual(course.final_grade_documents.count(), 1)
+        send_outgoing_emails()
         self.assertEqual(len(mail.outbox), expected_number_of_emails)
         response = self.app.get("/grades/download/{}".format(course.final_grade_documents.first().id), user="student")
         self.assertEqual(response.status_code, 200)
@@ -102,6 +104,7 @@ class GradeUploadTests(WebTest):
         self.assertEqual(response.status_code, 200)
         self.assertIn("Successfully", response)
         self.assertEqual(course.midterm_grade_documents.count(), 1)
+        send_outgoing_emails()
         self.assertEqual(len(mail.outbox), course.num_participants)
 
     def test_upload_final_grades(self):
@@ -176,6 +179,7 @@ class GradeUploadTests(WebTest):
         self.assertTrue(course.gets_no_grade_documents)
         # course should get published here
         self.assertEqual(course.state, "published")
+        send_outgoing_emails()
         self.assertEqual(len(mail.outbox), course.num_participants + course.contributions.exclude(contributor=None).count())
 
         self.get_submit_assert_302(toggle_url, "grade_publisher")
@@ -1,5 +1,5 @@
 from evap.evaluation.models import Questionnaire
-from evap.evaluation.tools import calculate_results, calculate_average_grades_and_deviation, get_grade_color, get_deviation_color, has_no_rating_answers
+from evap.evaluation.tools import calculate_results_for_courses, ResultMetadata, get_result_summary, get_grade_color, get_deviation_color, has_no_rating_answers
 
 from django.utils.translation import ugettext as _
 
@@ -82,6 +82,8 @@ class ExcelExporter(object):
         self.workbook = xlwt.Workbook()
         self.init_styles(self.workbook)
         counter = 1
+        # the sheets share questionnaires and questions
+        metadata = ResultMetadata()
 
         for course_types in course_types_list:
             self.sheet = self.workbook.add_sheet("Sheet " + str(counter))
@@ -95,12 +97,14 @@ class ExcelExporter(object):
                 course_states.extend(['evaluated', 'reviewed'])
 
             used_questionnaires = set()
-            for course in self.semester.course_set.filter(state__in=course_states, type__in=course_types).all():
+            courses = self.semester.course_set.filter(state__in=course_states, type__in=course_types).select_related('result_summary')
+            course_results = calculate_results_for_courses(courses, metadata)
+            for course, course_result in course_results.items():
                 if course.is_single_result():
                     continue
                 results = OrderedDict()
-                for questionnaire, contributor, label, data, section_warning in calculate_results(course):
-                    if has_no_rating_answers(course, contributor, questionnaire):
+                for questionnaire, contributor, label, data, section_warning in course_result.sections:
+                    if has_no_rating_answers(data):
                         continue
                     results.setdefault(questionnaire.id, []).extend(data)
                     used_questionnaires.add(questionnaire)
@@ -160,7 +164,7 @@ class ExcelExporter(object):
 
             writen(self, _("Overall Average Grade"), "bold")
             for course, results in courses_with_results:
-                avg, dev = calculate_average_grades_and_deviation(course)
+                avg = get_result_summary(course).average_grade
                 if avg:
                     writec(self, avg, self.grade_to_style(avg, total=True), cols=2)
                 else:
@@ -168,7 +172,7 @@ class ExcelExporter(object):
 
             writen(self, _("Overall Average Standard Deviation"), "bold")
             for course, results in courses_with_results:
-                avg, dev = calculate_average_grades_and_deviation(course)
+                dev = get_result_summary(course).deviation
                 if dev is not None:
                     writec(self, dev, self.deviation_to_style(dev, total=True), cols=2)
                 else:
@@ -176,8 +180,9 @@ class ExcelExporter(object):
 
             writen(self, _("Total Voters/Total Participants"), "bold")
             for course, results in courses_with_results:
-                percent_participants = float(course.num_voters)/float(course.num_participants) if course.num_participants > 0 else 0
-                writec(self, "{}/{} ({:.0%})".format(course.num_voters, course.num_participants, percent_participants), "total_voters", cols=2)
+                summary = get_result_summary(course)
+                percent_participants = float(summary.num_voters)/float(summary.num_participants) if summary.num_participants > 0 else 0
+                writec(self, "{}/{} ({:.0%})".format(summary.num_voters, summary.num_participants, percent_participants), "total_voters", cols=2)
 
         self.workbook.save(response)
 
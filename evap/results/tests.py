@@ -1,9 +1,27 @@
 from django_webtest import WebTest
 from django.test import TestCase
+from django.db import connection
+from django.core.cache import cache
+from django.core.management import call_command
+from django.core.management.base import CommandError
+from django.test.utils import CaptureQueriesContext
 
-from evap.evaluation.models import Semester
+from evap.evaluation.models import Semester, Course, Contribution, Questionnaire, Question, UserProfile, \
+                                   RatingAnswerCounter, RatingAnswerAggregate, TextAnswer, CourseResultSummary, EmailTemplate
+from evap.evaluation.tools import calculate_results, calculate_results_for_semester, calculate_average_grades_and_deviation, \
+                                  get_result_summary
+from evap.evaluation.tools import TextResult, ResultMetadata, calculate_results_for_courses, get_results_cache_keys, \
+                                  send_publish_notifications, get_results_lock_key, get_results_cache_key, \
+                                  get_results_cache_version_key, invalidate_results, \
+                                  RESULTS_CACHE_TIMEOUT, RESULTS_LOCK_WAIT, RESULTS_LOCK_POLL_INTERVAL
 from evap.results.exporters import ExcelExporter
 
+from model_mommy import mommy
+from contextlib import redirect_stdout
+from datetime import datetime, timedelta
+from io import StringIO
+from unittest.mock import patch
+
 class UsecaseTests(WebTest):
     fixtures = ['minimal_test_data_results']
 
@@ -130,3 +148,322 @@ class UnitTests(TestCase):
         self.assertEqual(exporter.normalize_number(2.8), 2.8)
 
 
+def make_course_with_answers(num_contributors, num_questions, semester=None, state='inEvaluation'):
+    """Makes a course with a general and num_contributors contributor questionnaires, each with num_questions
+    questions of every kind. Every rating question has three answers, every text question one."""
+    course = mommy.make(Course, state=state, semester=semester or mommy.make(Semester))
+    questionnaire = mommy.make(Questionnaire)
+    contributor_questionnaire = mommy.make(Questionnaire, is_for_contributors=True)
+    for i in range(num_questions):
+        mommy.make(Question, questionnaire=questionnaire, type="L")
+        mommy.make(Question, questionnaire=questionnaire, type="T")
+        mommy.make(Question, questionnaire=contributor_questionnaire, type="G")
+    course.general_contribution.questionnaires = [questionnaire]
+    for i in range(num_contributors):
+        mommy.make(Contribution, course=course, contributor=mommy.make(UserProfile), questionnaires=[contributor_questionnaire])
+
+    for contribution in course.contributions.all():
+        for questionnaire in contribution.questionnaires.all():
+            for question in questionnaire.question_set.all():
+                if question.is_rating_question:
+                    mommy.make(RatingAnswerCounter, contribution=contribution, question=question, answer=1, count=2)
+                    mommy.make(RatingAnswerCounter, contribution=contribution, question=question, answer=3, count=1)
+                else:
+                    mommy.make(TextAnswer, contribution=contribution, question=question, state=TextAnswer.PUBLISHED)
+    return course
+
+
+class CalculateResultsTests(TestCase):
+
+    def count_queries(self, course):
+        with CaptureQueriesContext(connection) as context:
+            calculate_results(course)
+        return len(context.captured_queries)
+
+    def test_number_of_queries_is_constant(self):
+        small_course = make_course_with_answers(num_contributors=1, num_questions=1)
+        large_course = make_course_with_answers(num_contributors=5, num_questions=8)
+
+        self.assertEqual(self.count_queries(small_course), self.count_queries(large_course))
+
+    def test_number_of_queries_for_cached_courses_is_constant(self):
+        """ Results of published courses are read from and written to the cache for all courses at once. """
+        semester = mommy.make(Semester)
+        few_courses = [make_course_with_answers(num_contributors=1, num_questions=1, semester=semester, state='published')]
+        many_courses = [make_course_with_answers(num_contributors=2, num_questions=2, semester=semester, state='published') for i in range(5)]
+
+        def count_queries(courses):
+            with CaptureQueriesContext(connection) as context:
+                calculate_results_for_courses(courses)
+            return len(context.captured_queries)
+
+        cache.clear()
+        self.assertEqual(count_queries(few_courses), count_queries(many_courses))
+        self.assertEqual(count_queries(few_courses), count_queries(many_courses))
+
+    def test_results(self):
+        course = make_course_with_answers(num_contributors=2, num_questions=2)
+        sections = calculate_results(course)
+
+        self.assertEqual(len(sections), 3)
+        self.assertIsNone(sections[0].contributor)
+        for section in sections:
+            for result in section.results:
+                if result.question.is_rating_question:
+                    self.assertEqual(result.total_count, 3)
+                    self.assertAlmostEqual(result.average, 5 / 3)
+                    self.assertEqual(list(result.counts.values()), [2, 0, 1, 0, 0])
+                else:
+                    self.assertEqual(len(result.answers), 1)
+
+    def test_statistics_are_read_from_the_aggregates(self):
+        course = make_course_with_answers(num_contributors=0, num_questions=1)
+        question = Question.objects.get(questionnaire__contributions__course=course, type="L")
+        RatingAnswerAggregate.objects.filter(question=question).update(count=4, sum=8, sum_of_squares=20)
+
+        result = next(result for section in calculate_results(course) for result in section.results if result.question == question)
+        self.assertEqual((result.total_count, result.average, result.deviation), (4, 2, 1))
+        # the distribution still comes from the counters
+        self.assertEqual(list(result.counts.values()), [2, 0, 1, 0, 0])
+
+    def test_aggregates_follow_changed_counters(self):
+        course = make_course_with_answers(num_contributors=0, num_questions=1)
+        counter = RatingAnswerCounter.objects.filter(contribution__course=course, answer=3).get()
+        counter.count = 3
+        counter.save()
+        aggregate = RatingAnswerAggregate.objects.get(question=counter.question)
+        self.assertEqual((aggregate.count, aggregate.sum, aggregate.sum_of_squares), (5, 11, 29))
+
+        counter.delete()
+        aggregate = RatingAnswerAggregate.objects.get(question=counter.question)
+        self.assertEqual((aggregate.count, aggregate.sum, aggregate.sum_of_squares), (2, 2, 2))
+
+    def test_semester_results_match_course_results(self):
+        semester = mommy.make(Semester)
+        courses = [make_course_with_answers(num_contributors=i, num_questions=2, semester=semester) for i in range(3)]
+
+        with CaptureQueriesContext(connection) as context:
+            results = calculate_results_for_semester(semester, states=['inEvaluation'])
+        self.assertLessEqual(len(context.captured_queries), self.count_queries(courses[0]) + 1)
+
+        self.assertEqual(list(results.keys()), sorted(courses, key=lambda course: course.name_de))
+        for course in courses:
+            self.assertEqual(results[course].sections, calculate_results(course))
+            self.assertEqual((results[course].average_grade, results[course].deviation), calculate_average_grades_and_deviation(course))
+
+    def test_result_summary_follows_state_and_answers(self):
+        course = make_course_with_answers(num_contributors=1, num_questions=1)
+        self.assertFalse(CourseResultSummary.objects.filter(course=course).exists())
+
+        course.evaluation_end()
+        course.save()
+        summary = CourseResultSummary.objects.get(course=course)
+        self.assertEqual((summary.average_grade, summary.deviation), calculate_average_grades_and_deviation(course))
+
+        counter = RatingAnswerCounter.objects.filter(contribution__course=course, answer=1).first()
+        counter.count = 10
+        counter.save()
+        course = Course.objects.get(pk=course.pk)
+        self.assertEqual((get_result_summary(course).average_grade, get_result_summary(course).deviation), calculate_average_grades_and_deviation(course))
+        self.assertNotEqual(get_result_summary(course).average_grade, summary.average_grade)
+
+    def test_result_summary_follows_contributions_and_questionnaires(self):
+        course = make_course_with_answers(num_contributors=1, num_questions=1)
+        course.evaluation_end()
+        course.save()
+        contribution = course.contributions.exclude(contributor=None).get()
+        RatingAnswerCounter.objects.filter(contribution=contribution, answer=3).update(count=10)
+        RatingAnswerAggregate.objects.filter(contribution=contribution).update(count=12, sum=32, sum_of_squares=92)
+
+        def assert_summary_is_up_to_date():
+            summary = CourseResultSummary.objects.get(course=course)
+            self.assertEqual((summary.average_grade, summary.deviation), calculate_average_grades_and_deviation(Course.objects.get(pk=course.pk)))
+            return summary.average_grade
+
+        question = Question.objects.get(questionnaire__contributions=contribution)
+        question.type = "L"
+        question.save()
+        average_grade = assert_summary_is_up_to_date()
+
+        contribution.questionnaires = []
+        self.assertNotEqual(assert_summary_is_up_to_date(), average_grade)
+
+    def test_result_summary_is_kept_while_results_cant_change(self):
+        course = make_course_with_answers(num_contributors=1, num_questions=1)
+        course.participants = mommy.make(UserProfile, _quantity=2)
+        course.evaluation_end()
+        course.save()
+        self.assertEqual(CourseResultSummary.objects.get(course=course).num_participants, 2)
+
+        with patch('evap.evaluation.tools.update_result_summary') as update_mock:
+            course.review_finished()
+            course.publish()
+            course.save()
+            course.unpublish()
+            course.save()
+        self.assertFalse(update_mock.called)
+        self.assertTrue(CourseResultSummary.objects.filter(course=course).exists())
+
+
+class ResultsCacheTests(TestCase):
+    def setUp(self):
+        self.course = make_course_with_answers(num_contributors=1, num_questions=1)
+        self.course.evaluation_end()
+        self.course.save()
+        self.counter = RatingAnswerCounter.objects.filter(contribution__course=self.course, answer=1).first()
+
+    def rating_counts(self):
+        course = Course.objects.get(pk=self.course.pk)
+        return [result.total_count for section in calculate_results(course) for result in section.results if result.question.is_rating_question]
+
+    def test_results_are_cached(self):
+        metadata = ResultMetadata()
+        calculate_results_for_courses([self.course], metadata)
+        # one query for the version of the results and one for the results, all other objects are known already
+        with self.assertNumQueries(2):
+            calculate_results_for_courses([self.course], metadata)
+
+    def test_cached_results_are_compact(self):
+        calculate_results(self.course)
+        cached_value = cache.get(get_results_cache_keys([self.course])[self.course])
+
+        def assert_compact(value):
+            if isinstance(value, (list, tuple)):
+                for item in value:
+                    assert_compact(item)
+            else:
+                self.assertIsInstance(value, (int, float, str, bool, type(None)))
+        assert_compact(cached_value)
+
+    def test_concurrent_requests_agree_on_the_version(self):
+        version_key = get_results_cache_version_key(self.course.id)
+        cache.delete(version_key)
+        get_many = cache.get_many
+
+        def get_many_while_another_request_adds_the_version(keys):
+            values = get_many(keys)
+            cache.add(version_key, 'other', RESULTS_CACHE_TIMEOUT)
+            return values
+
+        with patch.object(cache, 'get_many', side_effect=get_many_while_another_request_adds_the_version):
+            cache_key = get_results_cache_keys([self.course])[self.course]
+        self.assertEqual(cache_key, get_results_cache_key(self.course.id, 'other'))
+        self.assertEqual(get_results_cache_keys([self.course])[self.course], cache_key)
+
+    def test_outdated_results_are_removed(self):
+        calculate_results(self.course)
+        cache_key = get_results_cache_keys([self.course])[self.course]
+        invalidate_results([self.course.id])
+        self.assertIsNone(cache.get(cache_key))
+        self.assertNotEqual(get_results_cache_keys([self.course])[self.course], cache_key)
+
+        # nothing stays in the cache forever
+        with connection.cursor() as cursor:
+            cursor.execute("SELECT COUNT(*) FROM evap_db_cache WHERE expires > %s", [datetime.now() + timedelta(seconds=RESULTS_CACHE_TIMEOUT + 60)])
+            self.assertEqual(cursor.fetchone()[0], 0)
+
+    def test_answer_change_invalidates_results(self):
+        self.assertEqual(self.rating_counts(), [3, 3])
+        self.counter.count = 10
+        self.counter.save()
+        self.assertIn(11, self.rating_counts())
+
+    def test_questionnaire_change_invalidates_results(self):
+        question_texts = lambda: [result.question.text_de for section in calculate_results(self.course) for result in section.results]
+        self.assertNotIn("changed", question_texts())
+        question = self.counter.question
+        question.text_de = "changed"
+        question.save()
+        self.assertIn("changed", question_texts())
+
+    def test_textanswer_state_change_invalidates_results(self):
+        textanswer = TextAnswer.objects.filter(contribution__course=self.course).first()
+        count_textanswers = lambda: sum(len(result.answers) for section in calculate_results(self.course) for result in section.results if isinstance(result, TextResult))
+        self.assertEqual(count_textanswers(), 1)
+        textanswer.hide()
+        textanswer.save()
+        self.assertEqual(count_textanswers(), 0)
+
+    def test_publish_notifications_are_sent_after_warming_the_cache(self):
+        users = mommy.make(UserProfile, _quantity=2)
+        self.course.participants = users
+        self.course.voters = users
+        self.course.contributions.exclude(contributor=None).update(responsible=True)
+        cache.clear()
+
+        def assert_results_cached(user, **kwargs):
+            self.assertIsNotNone(cache.get(get_results_cache_keys([self.course])[self.course]))
+
+        with patch.object(EmailTemplate, 'send_publish_notifications_to_user', side_effect=assert_results_cached) as send_mock:
+            send_publish_notifications(evaluation_results_courses=[self.course])
+        self.assertEqual(send_mock.call_count, 3)
+
+    def test_concurrent_calculation_is_awaited(self):
+        cache_key = get_results_cache_keys([self.course])[self.course]
+        compact_sections = cache.get(cache_key)
+        cache.delete(cache_key)
+        # another process is calculating the results
+        cache.add(get_results_lock_key(cache_key), True)
+
+        def finish_calculation(seconds):
+            cache.set(cache_key, compact_sections)
+
+        with patch('evap.evaluation.tools.time.sleep', side_effect=finish_calculation) as sleep_mock, \
+                patch('evap.evaluation.tools._calculate_results_for_courses', return_value={}) as calculate_mock:
+            self.assertEqual(self.rating_counts(), [3, 3])
+        self.assertEqual(sleep_mock.call_count, 1)
+        self.assertFalse(any(call[0][0] for call in calculate_mock.call_args_list))
+
+    def test_failed_lock_write_is_not_awaited(self):
+        cache_key = get_results_cache_keys([self.course])[self.course]
+        cache.delete(cache_key)
+
+        # e.g. the database is locked by another process
+        with patch('evap.evaluation.tools._add_many_to_cache', return_value=[]), \
+                patch('evap.evaluation.tools.time.sleep') as sleep_mock:
+            self.assertEqual(self.rating_counts(), [3, 3])
+        self.assertFalse(sleep_mock.called)
+        self.assertIsNotNone(cache.get(cache_key))
+
+    def test_waiting_for_concurrent_calculation_is_bounded(self):
+        cache_key = get_results_cache_keys([self.course])[self.course]
+        cache.delete(cache_key)
+        cache.add(get_results_lock_key(cache_key), True)
+
+        with patch('evap.evaluation.tools.time.sleep') as sleep_mock:
+            self.assertEqual(self.rating_counts(), [3, 3])
+        self.assertEqual(sleep_mock.call_count, RESULTS_LOCK_WAIT / RESULTS_LOCK_POLL_INTERVAL)
+        self.assertIsNotNone(cache.get(cache_key))
+
+
+class RefreshResultsCacheTests(TestCase):
+    def setUp(self):
+        self.course = make_course_with_answers(num_contributors=1, num_questions=1, state='published')
+        self.other_course = make_course_with_answers(num_contributors=1, num_questions=1, state='published')
+        cache.clear()
+
+    def is_cached(self, course):
+        return cache.get(get_results_cache_keys([course])[course]) is not None
+
+    def refresh(self, **options):
+        with redirect_stdout(StringIO()) as output:
+            call_command('refresh_results_cache', **options)
+        return output.getvalue()
+
+    def test_semester(self):
+        self.refresh(semester=self.course.semester_id)
+        self.assertTrue(self.is_cached(self.course))
+        self.assertFalse(self.is_cached(self.other_course))
+
+    def test_skip_unchanged(self):
+        self.refresh()
+        invalidate_results([self.course.id])
+        with patch('evap.evaluation.management.commands.refresh_results_cache.calculate_results', wraps=calculate_results) as calculate_mock:
+            output = self.refresh(skip_unchanged=True)
+        self.assertIn("Skipping 1 courses", output)
+        self.assertEqual([call[0][0] for call in calculate_mock.call_args_list], [self.course])
+        self.assertTrue(self.is_cached(self.course))
+
+    def test_workers_are_refused_with_sqlite(self):
+        with self.assertRaises(CommandError):
+            self.refresh(workers=2)
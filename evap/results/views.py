@@ -5,7 +5,7 @@ from django.contrib.auth.decorators import login_required
 
 from evap.evaluation.auth import staff_required
 from evap.evaluation.models import Semester, Degree, Contribution
-from evap.evaluation.tools import calculate_results, calculate_average_grades_and_deviation, TextResult
+from evap.evaluation.tools import calculate_results_for_courses, get_result_summary, TextResult
 
 
 from collections import OrderedDict, namedtuple
@@ -21,11 +21,16 @@ def index(request):
 @login_required
 def semester_detail(request, semester_id):
     semester = get_object_or_404(Semester, id=semester_id)
-    courses = list(semester.course_set.filter(state="published").prefetch_related("degrees"))
+    courses = list(semester.course_set.filter(state="published").select_related("result_summary").prefetch_related("degrees"))
 
     # annotate each course object with its grades
     for course in courses:
-        course.avg_grade, course.avg_deviation = calculate_average_grades_and_deviation(course)
+        summary = get_result_summary(course)
+        course.avg_grade, course.avg_deviation = summary.average_grade, summary.deviation
+        course.num_voters, course.num_participants = summary.num_voters, summary.num_participants
+
+    single_results = [course for course in courses if course.is_single_result()]
+    single_result_sections = {course: course_results.sections for course, course_results in calculate_results_for_courses(single_results).items()}
 
     CourseTuple = namedtuple('CourseTuple', ('courses', 'single_results'))
 
@@ -33,9 +38,9 @@ def semester_detail(request, semester_id):
     for degree in Degree.objects.all():
         courses_by_degree[degree] = CourseTuple([], [])
     for course in courses:
-        if course.is_single_result():
+        if course in single_result_sections:
             for degree in course.degrees.all():
-                section = calculate_results(course)[0]
+                section = single_result_sections[course][0]
                 result = section.results[0]
                 courses_by_degree[degree].single_results.append((course, result))
         else:
@@ -54,7 +59,8 @@ def course_detail(request, semester_id, course_id):
     if not course.can_user_see_results(request.user):
         raise PermissionDenied
 
-    sections = calculate_results(course)
+    course_results = calculate_results_for_courses([course])[course]
+    sections = course_results.sections
 
     public_view = request.GET.get('public_view', 'false') # default: show own view
     public_view = {'true': True, 'false': False}.get(public_view.lower()) # convert parameter to boolean
@@ -94,7 +100,7 @@ def course_detail(request, semester_id, course_id):
 
     show_grades = request.user.is_staff or course.can_publish_grades
 
-    course.avg_grade, course.avg_deviation = calculate_average_grades_and_deviation(course)
+    course.avg_grade, course.avg_deviation = course_results.average_grade, course_results.deviation
 
     template_data = dict(
             course=course,
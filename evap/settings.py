@@ -47,6 +47,11 @@ CONTRIBUTION_PERCENTAGE = 0.5
 # number of reward points to be given to a student once all courses of a semester have been voted for
 REWARD_POINTS_PER_SEMESTER = 3
 
+# if enabled, votes are only written to a log and added to the answer counters later by the
+# run_tasks or process_ballot_log commands. this makes voting faster when many people vote at once.
+# until then, each logged ballot holds all answers of one voter, see LoggedBallot
+DEFERRED_VOTE_AGGREGATION = False
+
 # days before end date to send reminder
 REMIND_X_DAYS_AHEAD_OF_END_DATE = [2, 0]
 
@@ -93,12 +98,21 @@ DATABASES = {
 
 CACHES = {
     'default': {
-        'BACKEND': 'django.core.cache.backends.db.DatabaseCache',
+        # reads and writes several keys with one query each, see evaluation.cache
+        'BACKEND': 'evap.evaluation.cache.DatabaseCache',
         'LOCATION': 'evap_db_cache',
         'OPTIONS': {
-            'MAX_ENTRIES': 1000 # note that the results alone need one entry per course
+            'MAX_ENTRIES': 1000 # note that the results alone need two entries per course (see evaluation.tools.get_results_cache_keys)
         }
-    }
+    },
+    # rendered questionnaires of the vote page, see student_vote_questionnaire_group.html
+    'vote_fragments': {
+        'BACKEND': 'django.core.cache.backends.locmem.LocMemCache',
+        'LOCATION': 'vote_fragments',
+        'OPTIONS': {
+            'MAX_ENTRIES': 1000
+        }
+    },
 }
 
 # Config for feedback links
@@ -111,6 +125,16 @@ REPLY_TO_EMAIL = DEFAULT_FROM_EMAIL
 if DEBUG:
     EMAIL_BACKEND = 'django.core.mail.backends.console.EmailBackend'
 
+# emails are put into an outbox and sent in batches by the send_outgoing_emails command (also run by run_tasks).
+# each batch uses one connection and sends at most EMAIL_OUTBOX_RATE_LIMIT emails per second.
+# an email that can't be sent is tried again after EMAIL_OUTBOX_RETRY_DELAY seconds, doubling the delay after each failed attempt.
+# other processes don't send a batch for EMAIL_OUTBOX_CLAIM_TIMEOUT seconds, which must be longer than sending a batch takes
+EMAIL_OUTBOX_BATCH_SIZE = 100
+EMAIL_OUTBOX_RATE_LIMIT = 10
+EMAIL_OUTBOX_MAX_ATTEMPTS = 5
+EMAIL_OUTBOX_RETRY_DELAY = 60
+EMAIL_OUTBOX_CLAIM_TIMEOUT = 600
+
 # Config for legal notice
 # The HTML file which should be used must be located in evap\templates\legal_notice_text.html
 LEGAL_NOTICE_ACTIVE = False
@@ -330,8 +354,10 @@ TESTING = 'test' in sys.argv
 
 # speed up tests
 if TESTING:
-    DATABASES['default'] = {'ENGINE': 'django.db.backends.sqlite3'} # use sqlite
+    # use sqlite. the test database is a file, as tests that vote concurrently need several connections to it
+    DATABASES['default'] = {'ENGINE': 'django.db.backends.sqlite3', 'TEST': {'NAME': os.path.join(BASE_DIR, 'test_database.sqlite3')}}
     COMPRESS_PRECOMPILERS = () # disable compressor completely
+    EMAIL_OUTBOX_RATE_LIMIT = 0 # don't wait between sending emails
 
 # Django debug toolbar settings
 if DEBUG and not TESTING and ENABLE_DEBUG_TOOLBAR:
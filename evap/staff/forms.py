@@ -215,7 +215,7 @@ class CourseEmailForm(forms.Form, BootstrapMixin):
 
     # returns the number of recepients without an email address
     def missing_email_addresses(self):
-        recipients = self.template.recipient_list_for_course(self.instance, self.recipient_groups)
+        recipients = EmailTemplate.recipients_for_courses([self.instance], self.recipient_groups)
         return len([user for user in recipients if not user.email])
 
     def send(self):
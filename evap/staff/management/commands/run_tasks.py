@@ -1,11 +1,13 @@
 import datetime
-import operator
 import logging
+import time
 
-from django.core.management.base import BaseCommand
+from django.core.management.base import BaseCommand, CommandError
 from django.conf import settings
+from django.db import transaction
 
 from evap.evaluation.models import Course, EmailTemplate
+from evap.evaluation.tools import process_ballot_log, send_outgoing_emails, get_due_reminders
 
 logger = logging.getLogger(__name__)
 
@@ -14,33 +16,53 @@ class Command(BaseCommand):
     args = '<kind of jobs>'
     help = 'Runs updates/tasks based on time events'
 
+    def add_arguments(self, parser):
+        parser.add_argument('--dry-run', action='store_true', help='only print how many reminders the daily tasks would send')
+
     def update_courses(self):
         """ Updates courses state, when evaluation time begins/ends."""
+        # evaluations can only end when all their votes are counted
+        process_ballot_log()
         Course.update_courses()
 
-    def check_reminders(self):
+    def check_reminders(self, dry_run=False):
         logger.info("check_reminders called.")
         check_dates = []
         for number_of_days in settings.REMIND_X_DAYS_AHEAD_OF_END_DATE:
             check_dates.append(datetime.date.today() + datetime.timedelta(days=number_of_days))
 
-        recipients = set()
-        for course in Course.objects.filter(state='inEvaluation', vote_end_date__in=check_dates):
-            recipients.update(course.due_participants)
-
-        for recipient in recipients:
-            due_courses = dict()
-            for course in Course.objects.filter(participants=recipient, state='inEvaluation').exclude(voters=recipient):
-                due_courses[course] = (course.vote_end_date - datetime.date.today()).days
-            first_due_in_days = min(due_courses.values())
-            # sort courses by number of days left for evaluation and bring them to following format: [(course, due_in_days), ...]
-            due_courses = sorted(due_courses.items(), key=operator.itemgetter(1))
+        start = time.perf_counter()
+        reminders = get_due_reminders(check_dates)
+        if dry_run:
+            num_due_courses = sum(len(due_courses) for __, __, due_courses in reminders)
+            print("{} participants would be reminded of {} due courses. Planning the reminders took {:.2f} seconds.".format(
+                len(reminders), num_due_courses, time.perf_counter() - start))
+            return
 
-            EmailTemplate.send_reminder_to_user(recipient, first_due_in_days=first_due_in_days, due_courses=due_courses)
+        template = EmailTemplate.objects.get(name=EmailTemplate.STUDENT_REMINDER)
+        batch_size = settings.EMAIL_OUTBOX_BATCH_SIZE
+        for i in range(0, len(reminders), batch_size):
+            with transaction.atomic():
+                for recipient, first_due_in_days, due_courses in reminders[i:i + batch_size]:
+                    EmailTemplate.send_reminder_to_user(recipient, first_due_in_days=first_due_in_days, due_courses=due_courses, template=template)
+            self.send_emails()
         logger.info("check_reminders finished.")
 
+    def send_emails(self):
+        """ Sends the emails created by the other tasks and all other due emails in the outbox."""
+        while any(send_outgoing_emails()):
+            pass
+
     def handle(self, *args, **options):
-        if len(args) > 0 and args[0] == 'daily':
+        daily = len(args) > 0 and args[0] == 'daily'
+        if options['dry_run']:
+            if not daily:
+                raise CommandError("--dry-run is only supported for the daily tasks")
+            self.check_reminders(dry_run=True)
+            return
+
+        if daily:
             self.check_reminders()
         else:
             self.update_courses()
+        self.send_emails()
@@ -15,7 +15,8 @@ from django.db.utils import IntegrityError
 
 from evap.evaluation.models import Semester, Questionnaire, Question, UserProfile, Course, \
                             Contribution, TextAnswer, EmailTemplate, NotArchiveable, Degree
-from evap.evaluation.tools import calculate_average_grades_and_deviation
+from evap.evaluation.tools import calculate_average_grades_and_deviation, send_outgoing_emails
+from evap.staff.views import get_courses_with_prefetched_data
 from evap.staff.forms import CourseEmailForm, UserForm, ContributionFormSet, ContributionForm, \
                              CourseForm, ImportForm, UserImportForm
 from evap.contributor.forms import EditorContributionForm
@@ -258,6 +259,29 @@ class PerformanceTests(WebTest):
             self.app.get("/staff/user/", user="staff.user")
 
 
+    def test_num_queries_semester_view_counts(self):
+        """
+            ensures that the participant, voter and text answer counts of the
+            semester view are queried with a constant number of queries
+        """
+        semester = mommy.make(Semester)
+        users = mommy.make(UserProfile, _quantity=3)
+        for num_voters in range(1, 4):
+            course = mommy.make(Course, semester=semester, participants=users, voters=users[:num_voters])
+            contribution = mommy.make(Contribution, course=course, contributor=users[0], responsible=True)
+            mommy.make(TextAnswer, contribution=contribution, state=TextAnswer.NOT_REVIEWED, _quantity=num_voters)
+            mommy.make(TextAnswer, contribution=contribution, state=TextAnswer.PUBLISHED)
+
+        with self.assertNumQueries(5):
+            courses = list(get_courses_with_prefetched_data(semester))
+
+        for course in courses:
+            num_voters = course.voters.count()
+            self.assertEqual(course.num_participants, 3)
+            self.assertEqual(course.num_voters, num_voters)
+            self.assertEqual(course.num_textanswers, num_voters + 1)
+            self.assertEqual(course.num_reviewed_textanswers, 1)
+
 class UnitTests(TestCase):
 
     def test_users_are_deletable(self):
@@ -302,6 +326,30 @@ class UnitTests(TestCase):
         responsible_contribution.questionnaires.add(q)
         self.assertTrue(course.has_enough_questionnaires())
 
+    def test_course_email_form_counts_the_recipients_it_sends_to(self):
+        responsible = mommy.make(UserProfile, email="responsible@example.com")
+        delegate = mommy.make(UserProfile, email="")
+        responsible.delegates.add(delegate)
+        participants = mommy.make(UserProfile, email=iter(["", "participant@example.com"]), _quantity=2)
+        course = mommy.make(Course, participants=participants + [delegate])
+        mommy.make(Contribution, course=course, contributor=responsible, responsible=True, can_edit=True)
+
+        data = {"body": "wat", "subject": "some subject", "recipients": ["responsible", "all_participants"]}
+        form = CourseEmailForm(instance=course, data=data)
+        self.assertTrue(form.is_valid())
+        # the delegate gets the responsible's email in cc instead of an own one
+        self.assertEqual(form.missing_email_addresses(), 1)
+
+    def test_daily_tasks_send_reminders(self):
+        users = mommy.make(UserProfile, email=iter(["1@example.com", "2@example.com"]), _quantity=2)
+        mommy.make(Course, state='inEvaluation', vote_end_date=datetime.date.today() + datetime.timedelta(days=2), participants=users, voters=users[:1])
+
+        call_command("run_tasks", "daily", dry_run=True)
+        self.assertEqual(len(mail.outbox), 0)
+
+        call_command("run_tasks", "daily")
+        self.assertEqual([email.to for email in mail.outbox], [["2@example.com"]])
+
 
 @override_settings(INSTITUTION_EMAIL_DOMAINS=["example.com"])
 class URLTests(WebTest):
@@ -349,6 +397,7 @@ class URLTests(WebTest):
             ("test_staff", "/staff/", "evap"),
             # staff semester
             ("test_staff_semester_create", "/staff/semester/create", "evap"),
+            ("test_staff_email_outbox", "/staff/email/", "evap"),
             ("test_staff_semester_x", "/staff/semester/1", "evap"),
             ("test_staff_semester_x", "/staff/semester/1?tab=asdf", "evap"),
             ("test_staff_semester_x_edit", "/staff/semester/1/edit", "evap"),
@@ -713,6 +762,7 @@ class URLTests(WebTest):
         form["subject"] = "asdf"
         form["body"] = "asdf"
         form.submit()
+        send_outgoing_emails()
 
         self.assertEqual(len(mail.outbox), 2)
 
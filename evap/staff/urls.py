@@ -51,6 +51,8 @@ urlpatterns = [
     url(r"^template/$", RedirectView.as_view(url='/staff/', permanent=True)),
     url(r"^template/(\d+)$", template_edit, name="template_edit"),
 
+    url(r"^email/$", email_outbox, name="email_outbox"),
+
     url(r"faq/$", faq_index, name="faq_index"),
     url(r"faq/(\d+)$", faq_section, name="faq_section"),
 ]
@@ -1,6 +1,6 @@
 from django.contrib import messages
 from django.core.exceptions import PermissionDenied, SuspiciousOperation
-from django.db.models import Max, Count
+from django.db.models import Max, Count, Sum, Case, When, IntegerField
 from django.forms.models import inlineformset_factory, modelformset_factory
 from django.forms import formset_factory
 from django.shortcuts import get_object_or_404, redirect, render
@@ -13,7 +13,7 @@ from collections import defaultdict
 
 from evap.evaluation.auth import staff_required
 from evap.evaluation.models import Contribution, Course, Question, Questionnaire, Semester, \
-                                   TextAnswer, UserProfile, FaqSection, FaqQuestion, EmailTemplate, Degree
+                                   TextAnswer, UserProfile, FaqSection, FaqQuestion, EmailTemplate, Degree, OutgoingEmail
 from evap.evaluation.tools import STATES_ORDERED, questionnaires_and_contributions, get_textanswers, CommentSection, \
                                   TextResult, send_publish_notifications, sort_formset
 from evap.staff.forms import ContributionForm, AtLeastOneFormSet, CourseForm, CourseEmailForm, EmailTemplateForm, \
@@ -51,17 +51,17 @@ def get_courses_with_prefetched_data(semester):
         Prefetch("contributions", queryset=Contribution.objects.filter(responsible=True).select_related("contributor"), to_attr="responsible_contribution"),
         Prefetch("contributions", queryset=Contribution.objects.filter(contributor=None), to_attr="general_contribution"),
         "degrees")
-    participant_counts = semester.course_set.annotate(num_participants=Count("participants")).values_list("num_participants", flat=True)
-    voter_counts = semester.course_set.annotate(num_voters=Count("voters")).values_list("num_voters", flat=True)
-    textanswer_counts = semester.course_set.annotate(num_textanswers=Count("contributions__textanswer_set")).values_list("num_textanswers", flat=True)
 
-    for course, participant_count, voter_count, textanswer_count in zip(courses, participant_counts, voter_counts, textanswer_counts):
+    # the text answers are counted with one query for all courses, the participation counts are stored in the courses
+    textanswer_counts = {course_id: (count, reviewed_count) for course_id, count, reviewed_count in
+        TextAnswer.objects.filter(contribution__course__semester=semester).values_list("contribution__course_id")
+        .annotate(num_textanswers=Count("id"), num_reviewed_textanswers=Sum(Case(When(state=TextAnswer.NOT_REVIEWED, then=0), default=1, output_field=IntegerField())))
+        .order_by()}
+
+    for course in courses:
         course.general_contribution = course.general_contribution[0]
         course.responsible_contributor = course.responsible_contribution[0].contributor
-        course.num_textanswers = textanswer_count
-        if not semester.is_archived:
-            course.num_voters = voter_count
-            course.num_participants = participant_count
+        course.num_textanswers, course.num_reviewed_textanswers = textanswer_counts.get(course.id, (0, 0))
     return courses
 
 @staff_required
@@ -876,6 +876,24 @@ def template_edit(request, template_id):
         return render(request, "staff_template_form.html", dict(form=form, template=template))
 
 
+@staff_required
+def email_outbox(request):
+    if request.method == "POST":
+        count = OutgoingEmail.failed().update(attempts=0, next_attempt_time=datetime.datetime.now())
+        messages.success(request, ungettext("%(count)d failed email will be sent again.", "%(count)d failed emails will be sent again.", count) % {'count': count})
+        return redirect('staff:email_outbox')
+
+    one_week_ago = datetime.datetime.now() - datetime.timedelta(days=7)
+    template_data = dict(
+        num_pending=OutgoingEmail.pending().count(),
+        num_retried=OutgoingEmail.pending().filter(attempts__gt=0).count(),
+        num_failed=OutgoingEmail.failed().count(),
+        num_sent_last_week=OutgoingEmail.objects.filter(sent_time__gte=one_week_ago).count(),
+        unsent_emails=OutgoingEmail.objects.filter(sent_time=None).select_related('user')[:100],
+    )
+    return render(request, "staff_email_outbox.html", template_data)
+
+
 @staff_required
 def faq_index(request):
     sections = FaqSection.objects.all()
@@ -1,12 +1,53 @@
 from django import forms
+from django.utils.translation import get_language
 
 from evap.student.tools import make_form_identifier
 from evap.evaluation.tools import LIKERT_NAMES, GRADE_NAMES
 
+import copy
+
 
 LIKERT_CHOICES = [(str(k), v) for k, v in LIKERT_NAMES.items()]
 GRADE_CHOICES = [(str(k), v) for k, v in GRADE_NAMES.items()]
 
+# maps (questionnaire id, language) to the questionnaire version and its field specs, see get_field_specs
+_field_specs_cache = {}
+
+
+def get_field_specs(questionnaire):
+    """Returns a list of (question, field) tuples for the questions of the
+    questionnaire. The fields must be copied before using them in a form.
+
+    They are cached in the process, as questionnaires hardly ever change once
+    they are in use. A change of the questionnaire's version replaces the cached
+    fields. The language is part of the key as the field labels are translated."""
+    key = (questionnaire.id, get_language())
+    version, field_specs = _field_specs_cache.get(key, (None, None))
+    if version != questionnaire.version:
+        field_specs = [(question, make_field(question)) for question in questionnaire.question_set.all()]
+        _field_specs_cache[key] = (questionnaire.version, field_specs)
+    return field_specs
+
+
+def make_field(question):
+    # generic arguments for all kinds of fields
+    field_args = dict(label=question.text)
+
+    if question.is_text_question:
+        return forms.CharField(required=False, widget=forms.Textarea(),
+                               **field_args)
+    elif question.is_likert_question:
+        return forms.TypedChoiceField(widget=forms.RadioSelect(),
+                                      choices=LIKERT_CHOICES,
+                                      coerce=int,
+                                      **field_args)
+    elif question.is_grade_question:
+        return forms.TypedChoiceField(widget=forms.RadioSelect(),
+                                      choices=GRADE_CHOICES,
+                                      coerce=int,
+                                      **field_args)
+
+
 class QuestionsForm(forms.Form):
     """Dynamic form class that adds one field per question. Pass the arguments
     `contribution` and `questionnaire` to the constructor.
@@ -19,28 +60,14 @@ class QuestionsForm(forms.Form):
 
         super().__init__(*args, **kwargs)
 
-        for question in self.questionnaire.question_set.all():
-            # generic arguments for all kinds of fields
-            field_args = dict(label=question.text)
-
-            if question.is_text_question:
-                field = forms.CharField(required=False, widget=forms.Textarea(),
-                                        **field_args)
-            elif question.is_likert_question:
-                field = forms.TypedChoiceField(widget=forms.RadioSelect(),
-                                               choices=LIKERT_CHOICES,
-                                               coerce=int,
-                                               **field_args)
-            elif question.is_grade_question:
-                field = forms.TypedChoiceField(widget=forms.RadioSelect(),
-                                               choices=GRADE_CHOICES,
-                                               coerce=int,
-                                               **field_args)
-
+        # the questions of the questionnaire in the order of the fields
+        self.questions = []
+        for question, field in get_field_specs(self.questionnaire):
             identifier = make_form_identifier(self.contribution,
                                               self.questionnaire,
                                               question)
-            self.fields[identifier] = field
+            self.fields[identifier] = copy.deepcopy(field)
+            self.questions.append(question)
 
     def caption(self):
         return self.questionnaire.public_name
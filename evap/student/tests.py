@@ -1,8 +1,25 @@
 from django_webtest import WebTest
+from webtest import AppError
 from django.core.urlresolvers import reverse
-from evap.evaluation.models import Course, UserProfile, Contribution, Questionnaire, Question
+from django.core.cache import caches
+from django.core.cache.utils import make_template_fragment_key
+from django.db import connection, IntegrityError
+from django.test import Client, TransactionTestCase, override_settings
+from django.test.utils import CaptureQueriesContext
+from evap.evaluation.models import Course, UserProfile, Contribution, Questionnaire, Question, TextAnswer, RatingAnswerCounter, \
+                                   RatingAnswerAggregate, LoggedBallot
+from evap.evaluation.tools import add_answers, rebuild_rating_answer_aggregates, process_ballot_log
+from evap.student.tools import make_form_identifier
+from django_fsm import can_proceed
 from model_mommy import mommy
 
+from datetime import date
+from statistics import pstdev
+from threading import Thread
+from unittest import skipIf
+from unittest.mock import patch
+from uuid import UUID
+
 
 class VoteTests(WebTest):
 
@@ -28,3 +45,230 @@ class VoteTests(WebTest):
         response = get_vote_page(student)
         self.assertTrue(any(contributor == contributor1 for contributor, _, _, _ in response.context['contributor_form_groups']),
             "Regular students should see the questionnaire about a contributor")
+
+    def make_course_to_vote_on(self, num_participants):
+        self.participants = mommy.make(UserProfile, _quantity=num_participants)
+        course = mommy.make(Course, state='inEvaluation', participants=self.participants)
+        questionnaire = mommy.make(Questionnaire)
+        self.likert_question = mommy.make(Question, questionnaire=questionnaire, type="L")
+        self.text_question = mommy.make(Question, questionnaire=questionnaire, type="T")
+        course.general_contribution.questionnaires = [questionnaire]
+        contributor_questionnaire = mommy.make(Questionnaire, is_for_contributors=True)
+        self.grade_question = mommy.make(Question, questionnaire=contributor_questionnaire, type="G")
+        self.contribution = mommy.make(Contribution, contributor=mommy.make(UserProfile), course=course, questionnaires=[contributor_questionnaire])
+        return course
+
+    def vote(self, course, user, likert_answer, grade_answer, text_answer, other_answer=6):
+        general_contribution = course.general_contribution
+        page = self.app.get(reverse('student:vote', kwargs={'course_id': course.id}), user=user)
+        form = next(form for form in page.forms.values() if any(name.startswith("question_") for name in form.fields))
+        form[make_form_identifier(general_contribution, self.likert_question.questionnaire, self.likert_question)] = likert_answer
+        form[make_form_identifier(general_contribution, self.text_question.questionnaire, self.text_question)] = text_answer
+        form[make_form_identifier(self.contribution, self.grade_question.questionnaire, self.grade_question)] = grade_answer
+        for name in form.fields:
+            if other_answer is not None and name and name.startswith("question_") and form[name].value is None:
+                form[name] = other_answer
+        return form.submit(user=user)
+
+    def test_vote_updates_counters_and_aggregates(self):
+        course = self.make_course_to_vote_on(num_participants=3)
+        self.vote(course, self.participants[0], 1, 2, "first")
+        self.vote(course, self.participants[1], 1, 5, "")
+        self.vote(course, self.participants[2], 4, 6, "third")
+
+        self.assertEqual(set(course.voters.all()), set(self.participants))
+        self.assertEqual(Course.objects.get(pk=course.pk).num_voters, 3)
+        self.assertEqual(set(TextAnswer.objects.filter(contribution__course=course).values_list('original_answer', flat=True)), {"first", "third"})
+        self.assertEqual(RatingAnswerCounter.objects.get(question=self.likert_question, answer=1).count, 2)
+        self.assertEqual(RatingAnswerCounter.objects.get(question=self.likert_question, answer=4).count, 1)
+        # the answer 6 means "no answer"
+        self.assertEqual(RatingAnswerCounter.objects.filter(question=self.grade_question, answer=6).count(), 0)
+
+        likert_aggregate = RatingAnswerAggregate.objects.get(question=self.likert_question)
+        self.assertEqual((likert_aggregate.count, likert_aggregate.sum, likert_aggregate.sum_of_squares), (3, 6, 18))
+        self.assertAlmostEqual(likert_aggregate.average, 2)
+        self.assertAlmostEqual(likert_aggregate.deviation, pstdev([1, 1, 4]))
+
+        aggregates = list(RatingAnswerAggregate.objects.filter(contribution__course=course).order_by('pk').values())
+        rebuild_rating_answer_aggregates(Contribution.objects.filter(course=course))
+        rebuilt_aggregates = RatingAnswerAggregate.objects.filter(contribution__course=course).order_by('pk').values()
+        self.assertEqual([dict(aggregate, id=None) for aggregate in aggregates], sorted([dict(aggregate, id=None) for aggregate in rebuilt_aggregates], key=lambda aggregate: aggregate['question_id']))
+
+    def test_vote_is_retried_after_a_conflict(self):
+        course = self.make_course_to_vote_on(num_participants=1)
+        attempts = []
+
+        def conflict_once(rating_answers, text_answers):
+            attempts.append(rating_answers)
+            if len(attempts) == 1:
+                raise IntegrityError("UNIQUE constraint failed: evaluation_ratinganswercounter")
+            add_answers(rating_answers, text_answers)
+
+        with patch('evap.student.views.add_answers', side_effect=conflict_once), patch('evap.student.views.time.sleep') as sleep_mock:
+            self.assertEqual(self.vote(course, self.participants[0], 1, 2, "text").status_code, 302)
+
+        self.assertEqual(len(attempts), 2)
+        self.assertEqual(sleep_mock.call_count, 1)
+        self.assertEqual(list(course.voters.all()), self.participants)
+        self.assertEqual(RatingAnswerCounter.objects.get(question=self.likert_question).count, 1)
+        self.assertEqual(TextAnswer.objects.filter(contribution__course=course).count(), 1)
+
+    def test_concurrent_second_vote_of_a_user_is_rejected(self):
+        course = self.make_course_to_vote_on(num_participants=1)
+        course.voters.add(self.participants[0])
+
+        # the other vote was recorded after the view checked whether the user may vote
+        with patch.object(Course, 'can_user_vote', return_value=True):
+            with self.assertRaisesRegex(AppError, "403"):
+                self.vote(course, self.participants[0], 1, 2, "text")
+        self.assertEqual(Course.objects.get(pk=course.pk).num_voters, 1)
+        self.assertFalse(RatingAnswerCounter.objects.filter(contribution__course=course).exists())
+
+    def test_number_of_vote_queries_does_not_depend_on_number_of_questions(self):
+        def count_vote_queries(num_questions):
+            course = self.make_course_to_vote_on(num_participants=1)
+            for i in range(num_questions):
+                mommy.make(Question, questionnaire=self.likert_question.questionnaire, type="L")
+                mommy.make(Question, questionnaire=self.grade_question.questionnaire, type="G")
+            with CaptureQueriesContext(connection) as context:
+                self.vote(course, self.participants[0], 1, 2, "text", other_answer=3)
+            answer_tables = ("evaluation_ratinganswercounter", "evaluation_ratingansweraggregate", "evaluation_textanswer")
+            return len([query for query in context.captured_queries if any(table in query['sql'] for table in answer_tables)])
+
+        self.assertEqual(count_vote_queries(1), count_vote_queries(10))
+
+    def test_course_row_is_updated_last(self):
+        course = self.make_course_to_vote_on(num_participants=1)
+        with CaptureQueriesContext(connection) as context:
+            self.vote(course, self.participants[0], 1, 2, "text")
+        writes = [query['sql'] for query in context.captured_queries if query['sql'].startswith(('INSERT', 'UPDATE'))]
+        course_updates = [sql for sql in writes if sql.startswith('UPDATE "evaluation_course" ')]
+        self.assertEqual(len(course_updates), 1)
+        self.assertTrue(writes[-1].startswith('UPDATE "evaluation_course" '))
+
+    @override_settings(DEFERRED_VOTE_AGGREGATION=True)
+    def test_deferred_vote_aggregation(self):
+        course = self.make_course_to_vote_on(num_participants=2)
+        self.vote(course, self.participants[0], 1, 2, "first")
+        self.vote(course, self.participants[1], 3, 2, "")
+
+        self.assertEqual(course.voters.count(), 2)
+        self.assertFalse(RatingAnswerCounter.objects.filter(contribution__course=course).exists())
+        self.assertFalse(can_proceed(course.evaluation_end))
+        # the ids of the ballots don't tell in which order the participants voted
+        self.assertTrue(all(isinstance(ballot.pk, UUID) for ballot in LoggedBallot.objects.all()))
+
+        self.assertEqual(process_ballot_log(batch_size=1), 2)
+        self.assertFalse(LoggedBallot.objects.exists())
+        self.assertTrue(can_proceed(course.evaluation_end))
+        self.assertEqual(RatingAnswerCounter.objects.get(question=self.likert_question, answer=1).count, 1)
+        self.assertEqual(RatingAnswerCounter.objects.get(question=self.grade_question, answer=2).count, 2)
+        self.assertEqual(RatingAnswerAggregate.objects.get(question=self.likert_question).sum, 4)
+        self.assertEqual(list(TextAnswer.objects.filter(contribution__course=course).values_list('original_answer', flat=True)), ["first"])
+
+    def test_vote_page_uses_cached_fields(self):
+        course = self.make_course_to_vote_on(num_participants=1)
+        url = reverse('student:vote', kwargs={'course_id': course.id})
+        self.app.get(url, user=self.participants[0])
+
+        with CaptureQueriesContext(connection) as context:
+            self.app.get(url, user=self.participants[0])
+        self.assertFalse(any('"evaluation_question"' in query['sql'] for query in context.captured_queries))
+
+        self.likert_question.text_en = "changed question"
+        self.likert_question.save()
+        self.assertIn("changed question", self.app.get(url, user=self.participants[0]))
+
+    def test_unbound_questionnaires_are_rendered_once(self):
+        course = self.make_course_to_vote_on(num_participants=2)
+        mommy.make(Question, questionnaire=self.likert_question.questionnaire, type="L")
+        url = reverse('student:vote', kwargs={'course_id': course.id})
+        questionnaire = Questionnaire.objects.get(pk=self.likert_question.questionnaire_id)
+        fragment_key = make_template_fragment_key('student_vote_questionnaire', [course.general_contribution.id, questionnaire.id, questionnaire.version, 'en', False])
+
+        self.app.get(url, user=self.participants[0])
+        fragment = caches['vote_fragments'].get(fragment_key)
+        self.assertIn(self.likert_question.text_en, fragment)
+
+        caches['vote_fragments'].set(fragment_key, fragment + "<!-- cached -->")
+        self.assertIn("<!-- cached -->", self.app.get(url, user=self.participants[1]))
+
+        # bound forms are rendered again, e.g. when a question has not been answered
+        response = self.vote(course, self.participants[1], 1, 2, "text", other_answer=None)
+        self.assertNotIn("<!-- cached -->", response)
+        self.assertIn(self.likert_question.text_en, response)
+
+
+class StudentIndexTests(WebTest):
+    def setUp(self):
+        self.user = mommy.make(UserProfile)
+        self.course = mommy.make(Course, state='inEvaluation', participants=[self.user], voters=[])
+        self.vote_url = reverse('student:vote', kwargs={'course_id': self.course.id})
+
+    def test_index_shows_whether_the_user_voted(self):
+        self.assertIn(self.vote_url, self.app.get(reverse('student:index'), user=self.user))
+        self.course.voters.add(self.user)
+
+        page = self.app.get(reverse('student:index'), user=self.user)
+        self.assertNotIn(self.vote_url, page)
+        self.assertIn("You already evaluated this course", page)
+
+    def test_number_of_queries_does_not_depend_on_number_of_courses(self):
+        def count_queries():
+            with CaptureQueriesContext(connection) as context:
+                self.app.get(reverse('student:index'), user=self.user)
+            return len(context.captured_queries)
+
+        # the first request also logs the user in
+        count_queries()
+        num_queries = count_queries()
+        # single results need a query each, see Course.is_single_result
+        mommy.make(Course, state='published', participants=[self.user], voters=[self.user],
+                   vote_start_date=date(2016, 1, 1), vote_end_date=date(2016, 2, 1), _quantity=5)
+        mommy.make(Course, state='inEvaluation', participants=[self.user], semester=self.course.semester, _quantity=5)
+        self.assertEqual(count_queries(), num_queries)
+
+
+def test_database_is_in_memory():
+    return connection.vendor == 'sqlite' and connection.is_in_memory_db(connection.settings_dict['TEST']['NAME'] or ':memory:')
+
+
+# sqlite's in-memory test database can't be used from several threads, see settings.TESTING
+@skipIf(test_database_is_in_memory(), "the test database is in memory")
+class ConcurrentVoteTests(TransactionTestCase):
+    def test_concurrent_votes_are_all_counted(self):
+        participants = mommy.make(UserProfile, _quantity=20)
+        course = mommy.make(Course, state='inEvaluation', participants=participants)
+        questionnaire = mommy.make(Questionnaire)
+        question = mommy.make(Question, questionnaire=questionnaire, type="G")
+        course.general_contribution.questionnaires = [questionnaire]
+        identifier = make_form_identifier(course.general_contribution, questionnaire, question)
+        url = reverse('student:vote', kwargs={'course_id': course.id})
+
+        # assertions in the threads wouldn't make the test fail
+        errors = []
+
+        def vote(participant, answer):
+            try:
+                client = Client()
+                client.force_login(participant)
+                response = client.post(url, {identifier: answer})
+                if response.status_code != 302:
+                    errors.append("{} got status {}".format(participant, response.status_code))
+            except Exception as e:
+                errors.append(e)
+            finally:
+                connection.close()
+
+        threads = [Thread(target=vote, args=(participant, index % 2 + 1)) for index, participant in enumerate(participants)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        self.assertEqual(errors, [])
+        self.assertEqual(course.voters.count(), 20)
+        self.assertEqual(RatingAnswerCounter.objects.get(question=question, answer=1).count, 10)
+        self.assertEqual(RatingAnswerCounter.objects.get(question=question, answer=2).count, 10)
+        aggregate = RatingAnswerAggregate.objects.get(question=question)
+        self.assertEqual((aggregate.count, aggregate.sum), (20, 30))
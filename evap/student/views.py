@@ -1,35 +1,46 @@
+from django.conf import settings
 from django.contrib import messages
 from django.core.exceptions import PermissionDenied
-from django.db import transaction
+from django.db import transaction, IntegrityError, OperationalError
+from django.db.models import Case, F, IntegerField, Sum, When
 from django.shortcuts import get_object_or_404, redirect, render
 from django.utils.translation import ugettext as _
 
 from evap.evaluation.auth import participant_required
 from evap.evaluation.models import Course, Semester
-from evap.evaluation.tools import STUDENT_STATES_ORDERED
+from evap.evaluation.tools import STUDENT_STATES_ORDERED, add_answers, log_ballot
 
 from evap.student.forms import QuestionsForm
 from evap.student.tools import make_form_identifier
 
-from collections import OrderedDict
+from collections import OrderedDict, defaultdict
+import time
+
+# see vote
+VOTE_ATTEMPTS = 5
+VOTE_RETRY_DELAY = 0.1 # seconds, multiplied with the number of the attempt
+
 
 @participant_required
 def index(request):
     # retrieve all courses, where the user is a participant and that are not new
-    courses = list(set(Course.objects.filter(participants=request.user).exclude(state="new")))
-    voted_courses = list(set(Course.objects.filter(voters=request.user)))
-    due_courses = list(set(Course.objects.filter(participants=request.user, state='inEvaluation').exclude(voters=request.user)))
+    courses = Course.objects.filter(participants=request.user).exclude(state="new") \
+        .annotate(num_user_votes=Sum(Case(When(voters=request.user, then=1), default=0, output_field=IntegerField()))) \
+        .prefetch_related('grade_documents')
+    courses_by_semester = defaultdict(list)
+    for course in courses:
+        course.voted = course.num_user_votes > 0
+        course.due = course.state == 'inEvaluation' and not course.voted
+        courses_by_semester[course.semester_id].append(course)
 
-    sorter = lambda course: (list(STUDENT_STATES_ORDERED.keys()).index(course.student_state), course.vote_end_date, course.name)
-    courses.sort(key=sorter)
+    student_state_order = {state: index for index, state in enumerate(STUDENT_STATES_ORDERED.keys())}
+    sorter = lambda course: (student_state_order[course.student_state], course.vote_end_date, course.name)
 
-    semesters = Semester.objects.all()
-    semester_list = [dict(semester_name=semester.name, id=semester.id, courses=[course for course in courses if course.semester_id == semester.id]) for semester in semesters]
+    semesters = Semester.objects.filter(id__in=courses_by_semester.keys())
+    semester_list = [dict(semester_name=semester.name, id=semester.id, courses=sorted(courses_by_semester[semester.id], key=sorter)) for semester in semesters]
 
     template_data = dict(
         semester_list=semester_list,
-        voted_courses=voted_courses,
-        due_courses=due_courses,
         can_download_grades=request.user.can_download_grades,
     )
     return render(request, "student_index.html", template_data)
@@ -79,31 +90,49 @@ def vote(request, course_id):
                 preview=False)
         return render(request, "student_vote.html", template_data)
 
-    # all forms are valid, begin vote operation
-    with transaction.atomic():
-        for contribution, form_group in form_groups.items():
-            for questionnaire_form in form_group:
-                questionnaire = questionnaire_form.questionnaire
-                for question in questionnaire.question_set.all():
-                    identifier = make_form_identifier(contribution, questionnaire, question)
-                    value = questionnaire_form.cleaned_data.get(identifier)
-
-                    if question.is_text_question:
-                        if value:
-                            question.answer_class.objects.create(
-                                contribution=contribution,
-                                question=question,
-                                answer=value)
-                    else:
-                        if value != 6:
-                            answer_counter, created = question.answer_class.objects.get_or_create(contribution=contribution, question=question, answer=value)
-                            answer_counter.add_vote()
-                            answer_counter.save()
-
-        # remember that the user voted already
-        course.voters.add(request.user)
-
-        course.was_evaluated(request)
+    # all forms are valid, collect the answers
+    rating_answers = []
+    text_answers = []
+    for contribution, form_group in form_groups.items():
+        for questionnaire_form in form_group:
+            questionnaire = questionnaire_form.questionnaire
+            for question in questionnaire_form.questions:
+                identifier = make_form_identifier(contribution, questionnaire, question)
+                value = questionnaire_form.cleaned_data.get(identifier)
+
+                if question.is_text_question:
+                    if value:
+                        text_answers.append((contribution.id, question.id, value))
+                else:
+                    if value != 6:
+                        rating_answers.append((contribution.id, question.id, value))
+
+    # begin vote operation. the database might reject it because of concurrent votes,
+    # e.g. when it is locked or a counter has been created in the meantime. then it is retried.
+    for attempt in range(1, VOTE_ATTEMPTS + 1):
+        try:
+            with transaction.atomic():
+                # remember that the user voted already, which fails if the user voted concurrently. it doesn't send
+                # m2m_changed, the voter count is updated below. this is the first statement, as SQLite lets a
+                # transaction that has read already fail right away instead of waiting for the lock of another vote
+                Course.voters.through.objects.create(course_id=course.id, userprofile_id=request.user.id)
+
+                if settings.DEFERRED_VOTE_AGGREGATION:
+                    log_ballot(course, rating_answers, text_answers)
+                else:
+                    add_answers(rating_answers, text_answers)
+
+                course.was_evaluated(request)
+
+                # all votes of the course update its row, so it is locked as late as possible
+                Course.objects.filter(pk=course.pk).update(_voter_count=F('_voter_count') + 1)
+            break
+        except (IntegrityError, OperationalError):
+            if course.has_voted(request.user):
+                raise PermissionDenied
+            if attempt == VOTE_ATTEMPTS:
+                raise
+            time.sleep(VOTE_RETRY_DELAY * attempt)
 
     messages.success(request, _("Your vote was recorded."))
     return redirect('student:index')